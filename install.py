@@ -1,22 +1,196 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
 import subprocess
 import time
 import socket
+import selectors
+import select
+import errno
+import secrets
 import random
-import string
 import shutil
+import shlex
+import stat
+import tempfile
 from pathlib import Path
 import urllib.request
+import urllib.error
+import urllib.parse
+import http.client
+import ssl
+import json
 import getpass
-from typing import Tuple, Optional
-import socket
-import requests
+import glob
+import functools
+import hashlib
+from typing import Tuple, Optional, List, Dict, Union
 import threading
-import queue
-import datetime
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FuturesTimeoutError
+
+try:
+    import tomllib  # Python 3.11+; older interpreters skip the config self-check
+except ImportError:
+    tomllib = None
+
+# Conduwuit as seen from the host: COMPOSE_TEMPLATE publishes its port 8000 on port 80
+CONDUWUIT_LOCAL_URL = "http://localhost:80"
+HEALTH_URL = CONDUWUIT_LOCAL_URL + "/_matrix/client/versions"
+IP_LOOKUP_URL = "https://api.ipify.org"
+DNS_TIMEOUT = 5
+DOCKER_SOCKET = "/var/run/docker.sock"
+INSTALL_DIR = Path("/opt/conduwuit")
+COMPOSE_PROJECT = "conduwuit"  # docker-compose names the project after INSTALL_DIR
+DOCKER_SCRIPT_URL = "https://get.docker.com"
+DOCKER_APT_KEY_URL = "https://download.docker.com/linux/{distro}/gpg"
+DOCKER_APT_KEYRING = "/etc/apt/keyrings/docker.asc"
+DOCKER_APT_SOURCE = "/etc/apt/sources.list.d/docker.list"
+DOCKER_PACKAGES = ['docker-ce', 'docker-ce-cli', 'containerd.io', 'docker-compose-plugin']
+DOCKER_COMPOSE_URL = "https://github.com/docker/compose/releases/latest/download/docker-compose-Linux-x86_64"
+DOCKER_COMPOSE_TARGET = "/usr/local/bin/docker-compose"
+# Downloaded next to the target, then renamed over it once the checksum matches
+DOCKER_COMPOSE_DOWNLOAD = DOCKER_COMPOSE_TARGET + ".tmp"
+CERTBOT_SNAP_PATH = "/snap/bin/certbot"
+CERTBOT_LINK = "/usr/bin/certbot"
+CERTBOT_DEPLOY_HOOK = "/etc/letsencrypt/renewal-hooks/deploy/conduwuit.sh"
+# Have apt block on a held dpkg/apt lock itself instead of failing straight away
+APT_LOCK_TIMEOUT = 300
+APT_LOCK_OPTIONS = ["-o", f"DPkg::Lock::Timeout={APT_LOCK_TIMEOUT}"]
+
+# Alternative images to try, in order of preference
+CONDUWUIT_IMAGES = [
+    "ghcr.io/girlbossceo/conduwuit:v1.1.0",  # Try specific version first
+    "ghcr.io/girlbossceo/conduwuit:latest",  # Then latest
+    "ghcr.io/girlbossceo/conduwuit:stable",  # Then stable
+    "conduwuit/conduwuit:latest"             # Fallback to alternative repo
+]
+
+COTURN_IMAGES = [
+    "coturn/coturn:4.6.2",    # Try specific version first
+    "coturn/coturn:latest",   # Then latest
+    "coturn/coturn:alpine"    # Then alpine version
+]
+
+# Values are substituted as already-quoted TOML strings (see toml_string)
+CONDUWUIT_TEMPLATE = """[global]
+server_name = {server_name}
+database_path = "/data/conduwuit.db"
+signing_key = {signing_key}
+# Registration only succeeds with this token; the installer uses it for the admin account
+# and then sets allow_registration to false
+allow_registration = true
+registration_token = {registration_token}
+report_stats = false
+
+[turn]
+uris = [
+    {turn_uri},
+    {turns_uri}
+]
+secret = {turn_secret}
+ttl = 86400
+
+[tls]
+certs = "/certs/fullchain.pem"
+key = "/certs/privkey.pem"
+"""
+
+COTURN_TEMPLATE = """use-auth-secret
+static-auth-secret={turn_secret}
+realm={turn_domain}
+# Security
+no-tcp-traffic
+no-multicast-peers
+# TLS support
+cert=/certs/fullchain.pem
+pkey=/certs/privkey.pem
+# Ports
+listening-port=3478
+tls-listening-port=5349
+min-port=49152
+max-port=49252
+# Logging
+verbose
+# Other
+stale-nonce=0
+# External IP (will be auto-detected)
+external-ip=auto
+"""
+
+COMPOSE_TEMPLATE = """version: '3.8'
+services:
+  conduwuit:
+    image: {conduwuit_image}
+    restart: unless-stopped
+    ports:
+      - "80:8000"
+      - "443:8443"
+    volumes:
+      - ./data:/data
+      - ./certs:/certs
+    environment:
+      - CONDUWUIT_CONFIG=/data/conduwuit.toml
+      - RUST_LOG=info,conduwuit=debug
+    healthcheck:
+      test: ["CMD", "curl", "-f", "http://localhost:8000/_matrix/client/versions"]
+      interval: 10s
+      timeout: 5s
+      retries: 5
+      start_period: 30s
+    logging:
+      driver: "json-file"
+      options:
+        max-size: "10m"
+        max-file: "3"
+
+  coturn:
+    image: {coturn_image}
+    restart: unless-stopped
+    network_mode: host
+    volumes:
+      - ./coturn.conf:/etc/coturn/turnserver.conf:ro
+      - ./certs:/certs:ro
+    ports:
+      - "3478:3478/udp"
+      - "3478:3478/tcp"
+      - "5349:5349/udp"
+      - "5349:5349/tcp"
+      - "49152-49252:49152-49252/udp"
+    depends_on:
+      - conduwuit
+    logging:
+      driver: "json-file"
+      options:
+        max-size: "10m"
+        max-file: "3"
+"""
+
+# Ports the stack binds; TURN listens on UDP 3478 and relays media over the UDP range,
+# which a TCP connect can't see
+REQUIRED_TCP_PORTS = (80, 443, 3478)
+REQUIRED_UDP_PORTS = (3478,) + tuple(range(49152, 49253))
+
+# Log scans used by the fix paths; each is one case-insensitive pass over the text
+LOG_ERROR_PATTERN = re.compile(r"error|panic", re.IGNORECASE)
+LOG_ISSUE_PATTERN = re.compile(r"permission denied|connection refused|no such file or directory|config",
+                               re.IGNORECASE)
+# How compose releases without 'up --wait' reject it: v2 (cobra) errors, v1 (docopt) prints usage
+COMPOSE_UNKNOWN_FLAG_PATTERN = re.compile(r"unknown flag|no such option|^usage:", re.IGNORECASE | re.MULTILINE)
+
+# Fix paths only prune Docker when at least this much is reclaimable
+PRUNE_THRESHOLD = 256 * 1000 ** 2
+DOCKER_SIZE_UNITS = {"B": 1, "kB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3, "TB": 1000 ** 4}
+
+# Upper bound on log lines shown in "full" log views, so they don't re-read the whole log file
+LOG_TAIL_LINES = 200
+
+# Completed installation steps, so a re-run after a late failure can skip finished work
+INSTALL_STATE_FILE = "/var/lib/conduwuit/install.state"
+
+# Extra environment for anything that may run apt/dpkg
+NONINTERACTIVE_ENV = {'DEBIAN_FRONTEND': 'noninteractive'}
 
 # ANSI colors
 class Colors:
@@ -34,32 +208,480 @@ def print_warning(message: str) -> None:
 
 def print_error(message: str) -> None:
     print(f"{Colors.RED}[-]{Colors.NC} {message}")
+
+def print_errors(messages: List[str]) -> None:
+    """Print a block of error lines with a single write"""
+    sys.stdout.write("".join(f"{Colors.RED}[-]{Colors.NC} {message}\n" for message in messages))
+    sys.stdout.flush()
     
 def print_debug(message: str) -> None:
     print(f"{Colors.BLUE}[*]{Colors.NC} {message}")
 
-def run_command(command: str, shell: bool = False, env: dict = None) -> Tuple[int, str, str]:
-    """Run a command and return returncode, stdout, stderr"""
+def run_command(command: Union[str, List[str]], shell: bool = False, env: dict = None, capture: bool = True,
+                cwd: Union[str, Path] = None) -> Tuple[int, str, str]:
+    """Run a command and return returncode, stdout, stderr
+    
+    env holds extra variables on top of the current environment. A list command is executed directly; a string is split on whitespace unless shell=True.
+    With capture=False the output goes straight to the terminal and empty strings are returned.
+    """
     try:
-        # Set DEBIAN_FRONTEND to noninteractive for apt commands
-        custom_env = os.environ.copy()
-        if env:
-            custom_env.update(env)
-        if 'apt-get' in command:
-            custom_env['DEBIAN_FRONTEND'] = 'noninteractive'
-        
-        process = subprocess.Popen(
-            command if shell else command.split(),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+        # None inherits our environment; only build a merged copy when extras are given
+        custom_env = {**os.environ, **env} if env else None
+        
+        if isinstance(command, str) and not shell:
+            command = command.split()
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE if capture else None,
+            stderr=subprocess.PIPE if capture else None,
+            universal_newlines=True,
             shell=shell,
-            env=custom_env
+            env=custom_env,
+            cwd=cwd
         )
-        stdout, stderr = process.communicate()
-        return process.returncode, stdout.decode(), stderr.decode()
+        return result.returncode, result.stdout or "", result.stderr or ""
     except Exception as e:
         return 1, "", str(e)
 
+def run_in_background(func, *args) -> Future:
+    """Run func(*args) on a daemon thread and return a Future for its result
+    
+    Unlike ThreadPoolExecutor workers, daemon threads don't hold up interpreter exit,
+    so a sys.exit() on an error path never waits for background work to finish.
+    """
+    future = Future()
+    def runner():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=runner, daemon=True).start()
+    return future
+
+@functools.lru_cache(maxsize=1)
+def compose_command() -> Tuple[str, ...]:
+    """Prefer the 'docker compose' CLI plugin, falling back to the standalone docker-compose"""
+    returncode, stdout, stderr = run_command(["docker", "compose", "version"])
+    return ("docker", "compose") if returncode == 0 else ("docker-compose",)
+
+def run_compose(args: Union[str, List[str]], capture: bool = True) -> Tuple[int, str, str]:
+    """Run a compose subcommand against the project in INSTALL_DIR"""
+    if isinstance(args, str):
+        args = args.split()
+    # Pass the directory explicitly rather than relying on the process cwd
+    return run_command(list(compose_command()) + args, capture=capture, cwd=INSTALL_DIR)
+
+@functools.lru_cache(maxsize=128)
+def _resolve_cached(host: str):
+    try:
+        infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        # Cache failures too so retries don't re-query a known-bad name
+        return e
+    addresses = []
+    for info in infos:
+        if info[4][0] not in addresses:
+            addresses.append(info[4][0])
+    return addresses
+
+def resolve(host: str) -> List[str]:
+    """Resolve a hostname to its IPv4 addresses, memoized for the lifetime of the process"""
+    result = _resolve_cached(host.lower())
+    if isinstance(result, socket.gaierror):
+        raise result
+    return result
+
+def fetch_url(url: str, timeout: int = 30) -> str:
+    """Download a text resource into memory"""
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read().decode()
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix domain socket, for talking to the Docker Engine API"""
+    def __init__(self, path: str, timeout: float = 5):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+    
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+# Keep-alive connections reused across polls; http.client reconnects after close()
+_http_connections = {}
+
+def http_get(conn: http.client.HTTPConnection, path: str) -> Tuple[int, bytes]:
+    """Send a GET on a reusable connection and return status and body"""
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    except (OSError, http.client.HTTPException):
+        conn.close()
+        raise
+
+def check_health_endpoint(url: str = HEALTH_URL, timeout: int = 2) -> bool:
+    """Return whether the Matrix versions endpoint answers with HTTP 200"""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "https":
+        key = (parts.hostname, parts.port or 443)
+        if key not in _http_connections:
+            # Like curl -k: this checks reachability, certificate problems are reported elsewhere
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            _http_connections[key] = http.client.HTTPSConnection(*key, timeout=timeout, context=context)
+    else:
+        key = (parts.hostname, parts.port or 80)
+        if key not in _http_connections:
+            _http_connections[key] = http.client.HTTPConnection(*key, timeout=timeout)
+    try:
+        status, body = http_get(_http_connections[key], parts.path or "/")
+        return status == 200
+    except (OSError, http.client.HTTPException):
+        return False
+
+def matrix_login_works(username: str, password: str, timeout: int = 5) -> bool:
+    """Return whether a password login for the account succeeds"""
+    body = {"type": "m.login.password", "identifier": {"type": "m.id.user", "user": username},
+            "password": password}
+    request = urllib.request.Request(CONDUWUIT_LOCAL_URL + "/_matrix/client/v3/login",
+                                     data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def register_matrix_user(username: str, password: str, registration_token: str, timeout: int = 5) -> str:
+    """Register an account through the client-server API's registration token flow
+    
+    Returns "created", "exists" if the name is taken by an account this password can't
+    log into, or "" on failure. An existing account the password does log into (a re-run
+    with the kept data directory, or a retry after a request that timed out but went
+    through) counts as created.
+    """
+    url = CONDUWUIT_LOCAL_URL + "/_matrix/client/v3/register"
+    body = {"username": username, "password": password, "inhibit_login": True}
+    # The first request only opens a user-interactive auth session; the second completes it
+    for _ in range(2):
+        request = urllib.request.Request(url, data=json.dumps(body).encode(),
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout):
+                return "created"
+        except urllib.error.HTTPError as e:
+            try:
+                error = json.loads(e.read())
+            except ValueError:
+                return ""
+            if e.code == 400 and error.get("errcode") == "M_USER_IN_USE":
+                return "created" if matrix_login_works(username, password, timeout) else "exists"
+            if e.code != 401:
+                return ""
+            body["auth"] = {"type": "m.login.registration_token", "token": registration_token,
+                            "session": error.get("session")}
+        except OSError:
+            return ""
+    return ""
+
+def list_compose_containers(service: str = None) -> Optional[List[dict]]:
+    """List the compose project's containers from the Docker Engine API, or None if unreachable"""
+    labels = [f"com.docker.compose.project={COMPOSE_PROJECT}"]
+    if service:
+        labels.append(f"com.docker.compose.service={service}")
+    query = urllib.parse.urlencode({"all": "1", "filters": json.dumps({"label": labels})})
+    if DOCKER_SOCKET not in _http_connections:
+        _http_connections[DOCKER_SOCKET] = UnixHTTPConnection(DOCKER_SOCKET)
+    try:
+        status, body = http_get(_http_connections[DOCKER_SOCKET], f"/containers/json?{query}")
+        return json.loads(body) if status == 200 else None
+    except (OSError, http.client.HTTPException, ValueError):
+        return None
+
+def compose_ps_json(service: str = None) -> Optional[List[dict]]:
+    """List the project's containers from 'docker-compose ps --format json', or None if unsupported"""
+    command = ["ps", "-a", "--format", "json"]
+    if service:
+        command.append(service)
+    returncode, stdout, stderr = run_compose(command)
+    if returncode != 0:
+        return None
+    stdout = stdout.strip()
+    try:
+        # Older v2 releases print one JSON array, newer ones one object per line
+        if stdout.startswith("["):
+            return json.loads(stdout)
+        return [json.loads(line) for line in stdout.splitlines() if line.strip()]
+    except ValueError:
+        return None
+
+def compose_containers_failed() -> bool:
+    """Return whether any compose container has exited or is restarting"""
+    containers = list_compose_containers()
+    if containers is None:
+        containers = compose_ps_json()
+    if containers is None:
+        returncode, stdout, stderr = run_compose("ps -a")
+        return "Exit" in stdout or "Restarting" in stdout
+    return any(c.get("State") in ("exited", "restarting", "dead") for c in containers)
+
+def compose_service_healthy(service: str) -> bool:
+    """Return whether a compose service is up and reports a healthy healthcheck"""
+    containers = list_compose_containers(service)
+    if containers is None:
+        containers = compose_ps_json(service)
+    if containers is None:
+        returncode, stdout, stderr = run_compose(["ps", service])
+        return "Up" in stdout and "(healthy)" in stdout
+    # The Engine API only reports health inside Status; compose JSON also has a Health field
+    return any(c.get("State") == "running"
+               and (c.get("Health") == "healthy" or "(healthy)" in c.get("Status", ""))
+               for c in containers)
+
+def print_service_diagnostics() -> None:
+    """Print container states, what the Conduwuit logs point at, and the recent logs"""
+    print_error("Detailed diagnostics:")
+    if compose_containers_failed():
+        print_warning("Containers are not running properly:")
+    run_compose("ps -a", capture=False)
+    
+    if not compose_service_healthy("conduwuit"):
+        print_warning("Conduwuit container is not healthy")
+        returncode, logs, stderr = run_compose(["logs", "conduwuit", f"--tail={LOG_TAIL_LINES}"])
+        # Check for specific error patterns
+        if LOG_ERROR_PATTERN.search(logs):
+            print_warning("Found errors in Conduwuit logs")
+            lowered = logs.lower()
+            if "database" in lowered:
+                print_debug(f"Database issue detected, try: {' '.join(compose_command())} restart conduwuit")
+            elif "config" in lowered:
+                print_debug("Configuration issue detected")
+                print_debug("Please check your configuration file for errors")
+    
+    print_debug("Recent container logs:")
+    run_compose(["logs", f"--tail={LOG_TAIL_LINES}"], capture=False)
+
+def wait_for_healthy_event(service: str, timeout: float) -> bool:
+    """Block on the Docker event stream until a compose service reports healthy"""
+    filters = json.dumps({
+        "type": ["container"],
+        "event": ["health_status"],
+        "label": [f"com.docker.compose.project={COMPOSE_PROJECT}", f"com.docker.compose.service={service}"],
+    })
+    deadline = time.monotonic() + timeout
+    conn = UnixHTTPConnection(DOCKER_SOCKET, timeout=timeout)
+    try:
+        # Subscribe before looking at the current state so a transition in between isn't missed
+        conn.request("GET", "/events?" + urllib.parse.urlencode({"filters": filters}))
+        response = conn.getresponse()
+        if response.status != 200:
+            return compose_service_healthy(service)
+        if compose_service_healthy(service):
+            return True
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            conn.sock.settimeout(remaining)
+            line = response.readline()
+            if not line:
+                return False
+            if json.loads(line).get("Action") == "health_status: healthy":
+                return True
+    except (OSError, http.client.HTTPException, ValueError):
+        # Timed out or the event stream is unavailable; report the current state
+        return compose_service_healthy(service)
+    finally:
+        conn.close()
+
+def backoff_delay(attempt: int, cap: float = 30) -> float:
+    """Exponential backoff with jitter for the given zero-based retry attempt"""
+    return min(cap, 2 ** attempt + random.uniform(0, 1))
+
+def reset_permissions(root) -> None:
+    """Make a tree root-owned and owner-accessible in one walk, never loosening existing modes"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        os.chown(dirpath, 0, 0)
+        os.chmod(dirpath, stat.S_IMODE(os.stat(dirpath).st_mode) | 0o700)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            os.chown(path, 0, 0, follow_symlinks=False)
+            if stat.S_ISLNK(st.st_mode):
+                continue
+            # Only add owner read/write: the signing key config and privkey.pem stay private
+            os.chmod(path, stat.S_IMODE(st.st_mode) | 0o600)
+
+def write_file(path, content: str, mode: int = 0o644) -> None:
+    """Atomically replace a file: one unbuffered write to a temp file, fsync, then rename"""
+    data = content.encode()
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    os.close(fd)
+    # Readers see either the old file or the complete new one, never a partial write
+    os.replace(tmp_path, path)
+
+def download_file(url: str, target: str, timeout: int = 30) -> str:
+    """Stream a download into the target file and return its SHA-256"""
+    digest = hashlib.sha256()
+    with urllib.request.urlopen(url, timeout=timeout) as response, open(target, "wb") as f:
+        for chunk in iter(lambda: response.read(1024 * 1024), b""):
+            f.write(chunk)
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=1)
+def lookup_public_ip() -> str:
+    """Ask ipify for this server's public IP address"""
+    return fetch_url(IP_LOOKUP_URL, timeout=5).strip()
+
+_tool_paths = {}
+
+def find_tool(name: str, refresh: bool = False) -> Optional[str]:
+    """Look up an executable on PATH in-process, remembering where it was found"""
+    if refresh or name not in _tool_paths:
+        path = shutil.which(name)
+        if path is None:
+            # Don't cache misses; the tool may be installed later in the run
+            _tool_paths.pop(name, None)
+            return None
+        _tool_paths[name] = path
+    return _tool_paths[name]
+
+def wait_until(predicate, timeout: float, interval: float = 0.1, max_interval: float = 1) -> bool:
+    """Poll predicate with exponential backoff until it returns true or the timeout expires"""
+    deadline = time.monotonic() + timeout
+    while True:
+        if predicate():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+def unix_socket_accepts(path: str) -> bool:
+    """Return whether a Unix socket accepts a connection right now"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+
+def wait_for_unix_socket(path: str, timeout: float = 5) -> bool:
+    """Retry connecting to a Unix socket with exponential backoff until it accepts"""
+    return wait_until(lambda: unix_socket_accepts(path), timeout, interval=0.05)
+
+def docker_socket_ready() -> bool:
+    """Return whether the Docker daemon socket accepts connections"""
+    return unix_socket_accepts(DOCKER_SOCKET)
+
+def format_bytes(size: float) -> str:
+    """Format a byte count the way free -h / df -h do"""
+    for unit in ("B", "K", "M", "G", "T"):
+        if size < 1024 or unit == "T":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}B"
+        size /= 1024
+
+def print_system_resources() -> None:
+    """Print memory and disk usage from /proc/meminfo and statvfs without spawning free/df"""
+    meminfo = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                meminfo[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    if "MemTotal" in meminfo:
+        total = meminfo["MemTotal"]
+        available = meminfo.get("MemAvailable", meminfo.get("MemFree", 0))
+        print(f"Memory: {format_bytes(total - available)} used of {format_bytes(total)} ({format_bytes(available)} available)")
+        if meminfo.get("SwapTotal"):
+            swap_used = meminfo["SwapTotal"] - meminfo.get("SwapFree", 0)
+            print(f"Swap:   {format_bytes(swap_used)} used of {format_bytes(meminfo['SwapTotal'])}")
+    
+    for path in ("/", "/var/lib/docker", "/opt/conduwuit"):
+        if not os.path.exists(path):
+            continue
+        st = os.statvfs(path)
+        total = st.f_blocks * st.f_frsize
+        available = st.f_bavail * st.f_frsize
+        used = total - st.f_bfree * st.f_frsize
+        print(f"Disk {path}: {format_bytes(used)} used of {format_bytes(total)} ({format_bytes(available)} available)")
+
+def stream_command(command: List[str], input_data: str = None, env: dict = None) -> int:
+    """Run a command, echoing stdout and stderr line by line as they arrive, and return its exit code
+    
+    All pipes are multiplexed on one selector, so neither stream can fill up and stall the child
+    and nothing spins while it is idle.
+    """
+    with subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if input_data is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env={**os.environ, **env} if env else None
+    ) as process:
+        sel = selectors.DefaultSelector()
+        partial = {}
+        for pipe in (process.stdout, process.stderr):
+            os.set_blocking(pipe.fileno(), False)
+            sel.register(pipe, selectors.EVENT_READ)
+            partial[pipe] = b""
+        
+        pending = input_data.encode() if input_data is not None else b""
+        if pending:
+            os.set_blocking(process.stdin.fileno(), False)
+            sel.register(process.stdin, selectors.EVENT_WRITE)
+        elif process.stdin:
+            process.stdin.close()
+        
+        try:
+            while sel.get_map():
+                for key, _ in sel.select():
+                    pipe = key.fileobj
+                    if pipe is process.stdin:
+                        try:
+                            pending = pending[os.write(pipe.fileno(), pending[:65536]):]
+                        except BlockingIOError:
+                            continue
+                        except BrokenPipeError:
+                            pending = b""
+                        if not pending:
+                            sel.unregister(pipe)
+                            pipe.close()
+                        continue
+                    
+                    try:
+                        chunk = os.read(pipe.fileno(), 65536)
+                    except BlockingIOError:
+                        continue
+                    if not chunk:
+                        sel.unregister(pipe)
+                        chunk = b"\n"
+                    lines = (partial[pipe] + chunk).split(b"\n")
+                    partial[pipe] = lines.pop()
+                    for line in lines:
+                        if line.strip():
+                            print_debug(line.decode(errors="replace").strip())
+        finally:
+            sel.close()
+        return process.wait()
+
 def check_root() -> None:
     """Check if script is run as root"""
     if os.geteuid() != 0:
@@ -75,33 +697,229 @@ def check_system() -> None:
         print_error("This script requires a Debian/Ubuntu-based system")
         sys.exit(1)
 
+def port_in_use(port: int, timeout: float = 0.1) -> bool:
+    """Return whether something is accepting connections on a local TCP port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.settimeout(timeout)
+        return sock.connect_ex(('127.0.0.1', port)) == 0
+
+def udp_port_in_use(port: int) -> bool:
+    """Return whether a local UDP port is already bound, by trying to bind it"""
+    # No SO_REUSEADDR here: for UDP it would let the bind succeed alongside another user
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.bind(('0.0.0.0', port))
+        except OSError as e:
+            if e.errno == errno.EADDRINUSE:
+                return True
+            # Like a failed TCP connect, anything else doesn't show the port is taken
+            print_warning(f"Could not check UDP port {port}: {e.strerror}")
+        return False
+
+def _proc_net_address(hex_address: str) -> str:
+    """Decode an address from /proc/net/{tcp,udp}[6], stored as little-endian 32-bit words"""
+    raw = bytes.fromhex(hex_address)
+    packed = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, packed)
+
+def listening_sockets(ports) -> List[Tuple[str, str, int]]:
+    """List (protocol, address, port) for local sockets bound to the given ports, read from /proc/net"""
+    found = []
+    # TCP sockets in LISTEN (0A); unconnected UDP sockets show as CLOSE (07)
+    for proto, state in (("tcp", "0A"), ("tcp6", "0A"), ("udp", "07"), ("udp6", "07")):
+        try:
+            with open(f"/proc/net/{proto}") as f:
+                lines = f.read().splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            address, port = fields[1].split(":")
+            port = int(port, 16)
+            if port in ports and fields[3] == state:
+                found.append((proto, _proc_net_address(address), port))
+    return found
+
+def sweep_ports(ports: List[int], timeout: float = 0.5) -> List[int]:
+    """Probe all ports with one batch of non-blocking connects and return those in use"""
+    in_use = []
+    sel = selectors.DefaultSelector()
+    try:
+        # Submit every connect up front, then reap completions from a single selector
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            result = sock.connect_ex(('127.0.0.1', port))
+            if result == 0 or result == errno.EISCONN:
+                in_use.append(port)
+                sock.close()
+            elif result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                sel.register(sock, selectors.EVENT_WRITE, port)
+            else:
+                sock.close()
+        
+        deadline = time.monotonic() + timeout
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, _ in sel.select(remaining):
+                if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    in_use.append(key.data)
+                sel.unregister(key.fileobj)
+                key.fileobj.close()
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+    
+    return sorted(in_use)
+
 def check_ports() -> None:
     """Check if required ports are available"""
     print_debug("Checking if required ports are available...")
-    ports = [80, 443, 3478] + list(range(49152, 49252))
-    
-    for port in ports:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = sock.connect_ex(('127.0.0.1', port))
-        sock.close()
-        if result == 0:
-            print_error(f"Port {port} is already in use")
+    ports = REQUIRED_TCP_PORTS
+    
+    try:
+        in_use = sweep_ports(ports)
+    except OSError:
+        # Fall back to threaded probes if the batch sweep can't be set up (e.g. fd limits)
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            in_use = [port for port, busy in zip(ports, executor.map(port_in_use, ports)) if busy]
+    
+    if in_use:
+        print_error(f"Port {in_use[0]} is already in use")
+        sys.exit(1)
+    
+    for port in REQUIRED_UDP_PORTS:
+        if udp_port_in_use(port):
+            print_error(f"UDP port {port} is already in use")
             sys.exit(1)
 
-def install_packages() -> None:
+def stop_previous_stack() -> None:
+    """Stop the containers an unfinished previous run left up, so they don't hold the ports"""
+    if not (INSTALL_DIR / "docker-compose.yml").exists() or find_tool("docker") is None:
+        return
+    print_message("Stopping the containers left by the previous unfinished run...")
+    run_compose("down")
+
+def apt_lists_fresh(max_age: int = 3600) -> bool:
+    """Return whether apt-get update ran recently and no sources changed since"""
+    try:
+        updated = os.stat("/var/lib/apt/lists/partial").st_mtime
+    except OSError:
+        return False
+    
+    sources = ["/etc/apt/sources.list"] + glob.glob("/etc/apt/sources.list.d/*")
+    for source in sources:
+        try:
+            if os.stat(source).st_mtime > updated:
+                return False
+        except OSError:
+            continue
+    
+    return time.time() - updated < max_age
+
+def read_os_release() -> Dict[str, str]:
+    """Parse /etc/os-release into a dict"""
+    info = {}
+    try:
+        with open("/etc/os-release") as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep:
+                    info[key] = value.strip('"')
+    except OSError:
+        pass
+    return info
+
+def write_if_changed(path: str, content: str) -> None:
+    """Write a file only when its content differs, leaving its mtime alone otherwise"""
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return
+    except OSError:
+        pass
+    write_file(path, content)
+
+def configure_docker_repository(key_download: Optional[Future] = None) -> bool:
+    """Add Docker's apt repository so Docker installs with the other packages"""
+    os_release = read_os_release()
+    distro = os_release.get("ID")
+    codename = os_release.get("VERSION_CODENAME")
+    if distro not in ("ubuntu", "debian") or not codename:
+        print_warning("Docker apt repository not available for this distribution, using the install script")
+        return False
+    
+    returncode, arch, stderr = run_command("dpkg --print-architecture")
+    if returncode != 0:
+        return False
+    
+    print_debug("Adding Docker apt repository...")
+    try:
+        if key_download is not None:
+            key = key_download.result()
+        else:
+            key = fetch_url(DOCKER_APT_KEY_URL.format(distro=distro))
+        os.makedirs(os.path.dirname(DOCKER_APT_KEYRING), mode=0o755, exist_ok=True)
+        write_if_changed(DOCKER_APT_KEYRING, key)
+        write_if_changed(DOCKER_APT_SOURCE,
+                         f"deb [arch={arch.strip()} signed-by={DOCKER_APT_KEYRING}] "
+                         f"https://download.docker.com/linux/{distro} {codename} stable\n")
+    except Exception as e:
+        print_warning(f"Failed to add Docker apt repository, using the install script: {str(e)}")
+        return False
+    return True
+
+def link_certbot() -> None:
+    """Point /usr/bin/certbot at the snap, replacing any leftover binary in one rename"""
+    tmp_link = f"{CERTBOT_LINK}.tmp"
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(CERTBOT_SNAP_PATH, tmp_link)
+    os.replace(tmp_link, CERTBOT_LINK)
+    _tool_paths["certbot"] = CERTBOT_LINK
+
+def installed_packages(names: List[str]) -> List[str]:
+    """Return which of the named packages dpkg has installed (or has config files for)"""
+    # Names dpkg has never seen are reported on stderr and make the exit status non-zero,
+    # so only the listed lines matter
+    returncode, stdout, stderr = run_command(["dpkg-query", "-W", "-f=${Package} ${db:Status-Abbrev}\n"] + names)
+    installed = []
+    for line in stdout.splitlines():
+        fields = line.split()
+        # The second status letter is the current state; 'n' means not installed
+        if len(fields) == 2 and fields[1][1:2] != "n":
+            installed.append(fields[0])
+    return installed
+
+def install_packages(docker_key: Optional[Future] = None) -> None:
     """Install required packages"""
     print_message("Installing required packages...")
     
     # First, remove any existing certbot PPA to avoid errors
     print_debug("Removing any existing certbot repositories...")
-    run_command("rm -f /etc/apt/sources.list.d/certbot-*", shell=True)
+    for path in glob.glob("/etc/apt/sources.list.d/certbot-*"):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            print_warning(f"Could not remove {path}: {str(e)}")
+    
+    docker_repository = configure_docker_repository(docker_key)
     
     # Update package list
-    print_debug("Updating package lists...")
-    cmd = "apt-get update"
-    returncode, stdout, stderr = run_command(cmd)
-    if returncode != 0:
-        print_warning(f"Package list update warning (non-fatal): {stderr}")
+    if apt_lists_fresh():
+        print_debug("Package lists are up to date, skipping update")
+    else:
+        print_debug("Updating package lists...")
+        # Translated package descriptions are never shown, so don't download them
+        cmd = ["apt-get"] + APT_LOCK_OPTIONS + ["-o", "Acquire::Languages=none", "update"]
+        returncode, stdout, stderr = run_command(cmd, env=NONINTERACTIVE_ENV)
+        if returncode != 0:
+            print_warning(f"Package list update warning (non-fatal): {stderr}")
 
     # Install basic packages
     packages = [
@@ -112,36 +930,41 @@ def install_packages() -> None:
         'lsb-release',
         'software-properties-common',
         'net-tools',
-        'snapd',
-        'curl',
-        'python3-requests'  # Added for IP detection
+        'snapd'
     ]
     
-    print_debug("Installing basic packages...")
-    cmd = f"DEBIAN_FRONTEND=noninteractive apt-get install -y {' '.join(packages)}"
-    returncode, stdout, stderr = run_command(cmd, shell=True)
+    if docker_repository:
+        # Docker Engine and the Compose plugin come in the same transaction
+        packages += DOCKER_PACKAGES
+    
+    # Purge the distro certbot and its library in the same transaction (trailing '-' marks
+    # removal, which also takes its plugins); it is replaced by the snap below. Only
+    # packages dpkg actually has are listed: apt rejects the whole transaction over a
+    # removal it can't find in its indexes (e.g. Ubuntu without universe)
+    print_debug("Installing basic packages and removing any existing certbot installations...")
+    removals = [f"{name}-" for name in installed_packages(["certbot", "python3-certbot"])]
+    cmd = (["apt-get"] + APT_LOCK_OPTIONS + ["-o", "Dpkg::Use-Pty=0",
+                                            "install", "-y", "--purge", "-o", "APT::Get::AutomaticRemove=true"]
+           + packages + removals)
+    returncode, stdout, stderr = run_command(cmd, env=NONINTERACTIVE_ENV)
     if returncode != 0:
         print_error(f"Failed to install packages: {stderr}")
         sys.exit(1)
 
     # Ensure snapd is running
     print_debug("Ensuring snapd service is running...")
-    run_command("systemctl start snapd")
-    run_command("systemctl enable snapd")
+    run_command(["systemctl", "enable", "--now", "snapd"])
     
     # Wait for snap to be ready
     print_debug("Waiting for snap service to be ready...")
-    time.sleep(5)
+    if not wait_for_unix_socket("/run/snapd.socket", timeout=30):
+        print_warning("snapd socket is not accepting connections yet")
+    # Blocks inside snapd until the initial seeding is done, rather than guessing a delay
+    run_command("snap wait system seed.loaded")
     
     # Install certbot via snap
     print_debug("Installing Certbot via snap...")
     
-    # Remove any existing certbot
-    print_debug("Removing any existing certbot installations...")
-    run_command("apt-get remove -y certbot", shell=True)
-    run_command("apt-get autoremove -y", shell=True)
-    run_command("rm -f /usr/bin/certbot")
-    
     # Install certbot using snap
     print_debug("Installing Certbot...")
     max_retries = 3
@@ -151,247 +974,160 @@ def install_packages() -> None:
             break
         if i < max_retries - 1:
             print_warning(f"Failed to install Certbot (attempt {i+1}/{max_retries}). Retrying...")
-            time.sleep(5)
+            time.sleep(backoff_delay(i))
         else:
-            print_error("Failed to install Certbot via snap")
-            print_error("Please try installing certbot manually:")
-            print_error("sudo snap install --classic certbot")
-            print_error("sudo ln -s /snap/bin/certbot /usr/bin/certbot")
+            print_errors([
+                "Failed to install Certbot via snap",
+                "Please try installing certbot manually:",
+                "sudo snap install --classic certbot",
+                "sudo ln -s /snap/bin/certbot /usr/bin/certbot"
+            ])
             sys.exit(1)
     
-    # Create symlink
-    print_debug("Creating Certbot symlink...")
-    run_command("ln -sf /snap/bin/certbot /usr/bin/certbot")
-    
     # Final verification
     print_debug("Verifying Certbot installation...")
-    returncode, stdout, stderr = run_command("which certbot")
-    if returncode != 0:
+    if not os.access(CERTBOT_SNAP_PATH, os.X_OK):
         print_error("Failed to verify certbot installation")
         sys.exit(1)
     
+    print_debug("Creating Certbot symlink...")
+    link_certbot()
+    
     print_debug("Certbot installation verified successfully")
 
-def print_progress(iteration, total, prefix='', suffix='', length=50, fill='█'):
-    """Print a progress bar"""
-    percent = ("{0:.1f}").format(100 * (iteration / float(total)))
-    filled_length = int(length * iteration // total)
-    bar = fill * filled_length + '-' * (length - filled_length)
-    print(f'\r{prefix} |{bar}| {percent}% {suffix}', end='\r')
-    if iteration == total:
-        print()
-
-def kill_stuck_process(process_name: str) -> bool:
-    """Attempt to kill a stuck process"""
-    print_warning(f"Attempting to kill stuck {process_name} process...")
-    returncode, stdout, stderr = run_command(f"pkill {process_name}")
+def kill_stuck_processes(process_names: List[str]) -> bool:
+    """Attempt to kill stuck processes by exact name with a single pkill"""
+    if not process_names:
+        return False
+    names = ", ".join(process_names)
+    print_warning(f"Attempting to kill stuck processes: {names}...")
+    # -x anchors the whole alternation, so "dpkg" doesn't also match "dpkg-deb"
+    returncode, stdout, stderr = run_command(["pkill", "-x", "|".join(process_names)])
     if returncode == 0:
-        print_message(f"Successfully killed {process_name} process")
+        print_message(f"Successfully killed stuck processes: {names}")
         return True
     return False
 
-def check_and_fix_locks():
-    """Check for and attempt to fix package manager locks"""
-    lock_files = [
-        "/var/lib/dpkg/lock-frontend",
-        "/var/lib/apt/lists/lock",
-        "/var/lib/dpkg/lock"
-    ]
-    
-    for lock_file in lock_files:
-        if os.path.exists(lock_file):
-            print_warning(f"Removing lock file: {lock_file}")
-            try:
-                os.remove(lock_file)
-                print_message(f"Successfully removed {lock_file}")
-            except Exception as e:
-                print_error(f"Failed to remove {lock_file}: {str(e)}")
-
-def install_docker() -> None:
-    """Install Docker"""
-    print_message("Installing Docker...")
-    
-    # Wait for any package manager locks
-    def check_package_locks():
-        lock_files = [
-            "/var/lib/dpkg/lock-frontend",
-            "/var/lib/apt/lists/lock",
-            "/var/lib/dpkg/lock"
-        ]
-        processes = ["unattended-upgr", "apt-get", "dpkg"]
-        
-        # Check for lock files
-        locks_found = []
-        for lock_file in lock_files:
-            if os.path.exists(lock_file):
-                locks_found.append(lock_file)
-        
-        # Check for running processes
-        procs_found = []
-        for proc in processes:
-            returncode, stdout, stderr = run_command(f"pgrep {proc}")
-            if returncode == 0:
-                procs_found.append(proc)
-        
-        return locks_found, procs_found
-    
-    # Wait for package manager to be available
-    max_wait_time = 120  # Reduce max wait time to 2 minutes
-    check_interval = 5
-    total_checks = max_wait_time // check_interval
-    start_time = time.time()
-    auto_fix_threshold = 30  # Try auto-fixing after 30 seconds
-    
-    for i in range(total_checks):
-        current_time = time.time() - start_time
-        locks_found, procs_found = check_package_locks()
-        
-        # Print progress and status
-        print_progress(i + 1, total_checks, 
-                      prefix='Waiting for package manager:', 
-                      suffix=f'Time elapsed: {int(current_time)}s')
-        
-        if not locks_found and not procs_found:
-            print_message("\nPackage manager is now available")
-            break
-        
-        # Print current status
-        if locks_found:
-            print_warning(f"\nLock files detected: {', '.join(locks_found)}")
-        if procs_found:
-            print_warning(f"Running processes detected: {', '.join(procs_found)}")
-        
-        # Auto-fix after threshold
-        if current_time > auto_fix_threshold:
-            print_warning("\nPackage manager appears stuck - attempting automatic fix...")
-            
-            # Kill stuck processes
-            for proc in procs_found:
-                if kill_stuck_process(proc):
-                    time.sleep(1)
-            
-            # Remove lock files
-            check_and_fix_locks()
-            
-            # Wait a bit after fixing
-            time.sleep(2)
-            
-            # Check if fixed
-            locks_found, procs_found = check_package_locks()
-            if not locks_found and not procs_found:
-                print_message("Successfully fixed package manager locks")
-                break
-            
-            # If not fixed, ask user
-            print_warning("\nAutomatic fix incomplete. Options:")
-            print("1. Continue waiting")
-            print("2. Try more aggressive fix (force remove locks)")
-            print("3. Exit and try again later")
-            
-            choice = input("\nChoose an option (1-3): ").strip()
-            if choice == "2":
-                # More aggressive fix
-                run_command("killall -9 apt apt-get dpkg unattended-upgr", shell=True)
-                run_command("rm -f /var/lib/dpkg/lock* /var/lib/apt/lists/lock")
-                run_command("dpkg --configure -a")
-                time.sleep(5)
-            elif choice == "3":
-                print_error("Installation cancelled by user")
-                sys.exit(1)
-        
-        time.sleep(check_interval)
-    
-    if check_package_locks()[0] or check_package_locks()[1]:
-        print_error("\nTimeout waiting for package manager locks to be released")
-        print_error("Please try these steps manually:")
-        print_error("1. Wait a few minutes and try again")
-        print_error("2. Run these commands to fix stuck locks:")
-        print_error("   sudo killall -9 apt apt-get dpkg unattended-upgr")
-        print_error("   sudo rm -f /var/lib/dpkg/lock*")
-        print_error("   sudo rm -f /var/lib/apt/lists/lock")
-        print_error("   sudo dpkg --configure -a")
-        sys.exit(1)
-    
+def install_docker_from_script(script_download: Optional[Future] = None) -> None:
+    """Install Docker with the get.docker.com convenience script"""
     # Download Docker install script
     print_debug("Downloading Docker install script...")
     try:
-        urllib.request.urlretrieve("https://get.docker.com", "get-docker.sh")
+        if script_download is not None:
+            script = script_download.result()
+        else:
+            script = fetch_url(DOCKER_SCRIPT_URL)
     except Exception as e:
         print_error(f"Failed to download Docker install script: {str(e)}")
         sys.exit(1)
     
-    # Install Docker with retry logic and progress indicator
-    print_debug("Installing Docker...")
-    max_retries = 3
-    for i in range(max_retries):
-        print_message(f"Docker installation attempt {i+1}/{max_retries}")
-        
-        process = subprocess.Popen(
-            ["sh", "get-docker.sh"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
-        )
-        
-        while True:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                print_debug(output.strip())
-        
-        returncode = process.poll()
-        if returncode == 0:
-            break
+    # The script runs apt-get itself; an extra config file passed through APT_CONFIG
+    # makes those calls wait for a held package lock instead of failing
+    with tempfile.NamedTemporaryFile("w", prefix="conduwuit-apt-", suffix=".conf") as apt_conf:
+        apt_conf.write(f'DPkg::Lock::Timeout "{APT_LOCK_TIMEOUT}";\n')
+        apt_conf.flush()
+        env = {**NONINTERACTIVE_ENV, "APT_CONFIG": apt_conf.name}
+        
+        # Install Docker with retry logic and progress indicator
+        print_debug("Installing Docker...")
+        max_retries = 3
+        for i in range(max_retries):
+            print_message(f"Docker installation attempt {i+1}/{max_retries}")
             
-        if i < max_retries - 1:
-            print_warning(f"Docker installation attempt {i+1} failed. Retrying in 10 seconds...")
-            time.sleep(10)
-        else:
-            print_error("Docker installation failed after multiple attempts")
-            print_error("Please try installing Docker manually:")
-            print_error("curl -fsSL https://get.docker.com | sudo sh")
-            sys.exit(1)
+            # Feed the script to sh from memory instead of a file on disk
+            returncode = stream_command(["sh", "-s"], input_data=script, env=env)
+            if returncode == 0:
+                break
+                
+            if i < max_retries - 1:
+                delay = backoff_delay(i)
+                print_warning(f"Docker installation attempt {i+1} failed. Retrying in {delay:.0f} seconds...")
+                time.sleep(delay)
+            else:
+                print_errors([
+                    "Docker installation failed after multiple attempts",
+                    "Please try installing Docker manually:",
+                    "curl -fsSL https://get.docker.com | sudo sh"
+                ])
+                sys.exit(1)
+
+def install_docker(script_download: Optional[Future] = None) -> None:
+    """Install Docker"""
+    print_message("Installing Docker...")
+    
+    # Docker normally comes from its apt repository in install_packages();
+    # the convenience script is only the fallback
+    if find_tool("docker", refresh=True) is None:
+        install_docker_from_script(script_download)
+    else:
+        print_debug("Docker is already installed, skipping the install script")
     
-    # Start Docker service with progress indicator
+    # Enable and start Docker in one systemd call; without --no-block systemctl already
+    # waits for the start job to finish. The socket check covers socket activation,
+    # where the job completes before dockerd accepts connections
     print_debug("Starting Docker service...")
-    max_wait = 30
-    for i in range(max_wait):
-        print_progress(i + 1, max_wait, prefix='Starting Docker service:', suffix='Please wait...')
-        returncode, stdout, stderr = run_command("systemctl is-active docker")
-        if returncode == 0:
-            print_message("\nDocker service started successfully")
-            break
-        run_command("systemctl start docker")
-        time.sleep(1)
+    run_command(["systemctl", "enable", "--now", "docker"])
+    if wait_until(docker_socket_ready, timeout=30):
+        print_message("Docker service started successfully")
     else:
-        print_error("\nFailed to start Docker service")
-        print_error("Please check Docker service status:")
-        print_error("sudo systemctl status docker")
+        print_errors([
+            "\nFailed to start Docker service",
+            "Please check Docker service status:",
+            "sudo systemctl status docker"
+        ])
         sys.exit(1)
-    
-    # Enable Docker service
-    run_command("systemctl enable docker")
-    
-    # Clean up install script
-    try:
-        os.remove("get-docker.sh")
-    except:
-        pass
 
 def install_docker_compose() -> None:
     """Install Docker Compose"""
     print_message("Installing Docker Compose...")
     
-    # Get latest version
-    url = "https://github.com/docker/compose/releases/latest/download/docker-compose-Linux-x86_64"
-    target = "/usr/local/bin/docker-compose"
+    # Compare against the checksum published alongside the release asset
+    try:
+        expected = fetch_url(DOCKER_COMPOSE_URL + ".sha256", timeout=10).split()[0].lower()
+    except Exception as e:
+        expected = None
+        print_warning(f"Could not fetch Docker Compose checksum, skipping verification: {str(e)}")
     
     print_debug("Downloading Docker Compose...")
-    urllib.request.urlretrieve(url, target)
-    os.chmod(target, 0o755)
+    max_retries = 3
+    for i in range(max_retries):
+        try:
+            digest = download_file(DOCKER_COMPOSE_URL, DOCKER_COMPOSE_DOWNLOAD)
+        except (OSError, http.client.HTTPException) as e:
+            problem = f"download failed: {str(e)}"
+        else:
+            if expected is None or digest == expected:
+                break
+            problem = f"checksum mismatch (expected {expected}, got {digest})"
+        # Each attempt starts from an empty temp file; drop the bad one before backing off
+        if os.path.exists(DOCKER_COMPOSE_DOWNLOAD):
+            os.remove(DOCKER_COMPOSE_DOWNLOAD)
+        if i < max_retries - 1:
+            print_warning(f"Docker Compose {problem} (attempt {i+1}/{max_retries}). Retrying...")
+            time.sleep(backoff_delay(i))
+    else:
+        # Any existing binary was never touched
+        print_error(f"Failed to install Docker Compose: {problem}")
+        sys.exit(1)
+    # Only a verified, complete binary ever appears on PATH
+    os.chmod(DOCKER_COMPOSE_DOWNLOAD, 0o755)
+    os.replace(DOCKER_COMPOSE_DOWNLOAD, DOCKER_COMPOSE_TARGET)
+
+def timed_input(prompt: str, timeout: float = 15, default: str = "") -> str:
+    """Prompt for a line of input, returning default if nothing is entered within timeout seconds"""
+    print(prompt, end="", flush=True)
+    try:
+        ready, _, _ = select.select([sys.stdin], [], [], timeout)
+    except (OSError, ValueError):
+        # stdin closed or not selectable
+        ready = []
+    if not ready:
+        print()
+        return default
+    # A readable stdin at EOF (e.g. unattended runs) reads as an empty line
+    return sys.stdin.readline().strip() or default
 
-def get_user_input() -> Tuple[str, str, str, str]:
+def get_user_input(ip_lookup: Optional[Future] = None) -> Tuple[str, str, str, str]:
     """Get user input for configuration"""
     # Get domain name
     while True:
@@ -406,7 +1142,7 @@ def get_user_input() -> Tuple[str, str, str, str]:
     
     # Get server IP
     try:
-        ip = requests.get('https://api.ipify.org').text.strip()
+        ip = ip_lookup.result() if ip_lookup is not None else lookup_public_ip()
     except:
         ip = input("Enter your server's public IP address: ").strip()
     
@@ -438,15 +1174,22 @@ def get_user_input() -> Tuple[str, str, str, str]:
     
     # Verify domains resolve
     print_debug("Verifying domain DNS...")
-    try:
-        resolved_ip = socket.gethostbyname(matrix_domain)
-        if resolved_ip != ip:
-            print_warning(f"Warning: {matrix_domain} resolves to {resolved_ip}, but your server IP is {ip}")
-        resolved_ip = socket.gethostbyname(turn_domain)
-        if resolved_ip != ip:
-            print_warning(f"Warning: {turn_domain} resolves to {resolved_ip}, but your server IP is {ip}")
-    except socket.gaierror:
-        print_warning(f"Unable to resolve {matrix_domain} or {turn_domain}")
+    # Resolve both names concurrently and report each one on its own; a hung
+    # resolver is treated as unresolved rather than stalling the installer
+    lookups = [(name, run_in_background(resolve, name)) for name in (matrix_domain, turn_domain)]
+    deadline = time.monotonic() + DNS_TIMEOUT
+    unresolved = []
+    for name, lookup in lookups:
+        try:
+            addresses = lookup.result(timeout=max(0, deadline - time.monotonic()))
+        except (FuturesTimeoutError, socket.gaierror):
+            print_warning(f"Unable to resolve {name}")
+            unresolved.append(name)
+            continue
+        if ip not in addresses:
+            print_warning(f"Warning: {name} resolves to {', '.join(addresses)}, but your server IP is {ip}")
+    
+    if unresolved:
         print_warning("DNS records may not have propagated yet")
         if input("Continue anyway? (y/N): ").lower() != 'y':
             sys.exit(1)
@@ -473,38 +1216,35 @@ def get_user_input() -> Tuple[str, str, str, str]:
     
     return matrix_domain, turn_domain, email, admin_user, admin_pass
 
-def get_ssl_certificate(domain: str, email: str) -> None:
-    """Get SSL certificate from Let's Encrypt"""
+def get_ssl_certificate(domains: List[str], email: str) -> None:
+    """Get a single SAN certificate covering all domains from Let's Encrypt"""
     print_message("Obtaining SSL certificate...")
     
     # Stop any services using port 80
     print_debug("Stopping any services using port 80...")
     services_to_stop = ['apache2', 'nginx', 'httpd']
-    for service in services_to_stop:
-        run_command(f"systemctl stop {service}", shell=True)
+    # One systemd transaction; units that don't exist are reported and skipped
+    run_command(["systemctl", "stop"] + services_to_stop)
     
     # Verify port 80 is available
     print_debug("Verifying port 80 is available...")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    result = sock.connect_ex(('127.0.0.1', 80))
-    sock.close()
-    if result == 0:
+    if port_in_use(80):
         print_error("Port 80 is still in use. Please free it before continuing.")
         sys.exit(1)
     
+    # Verify certbot is available
+    if find_tool("certbot") is None:
+        print_error("Certbot not found. Please ensure it's installed correctly.")
+        sys.exit(1)
+    
     # Try to get SSL certificate
     max_retries = 3
     for i in range(max_retries):
         print_debug(f"Attempting to obtain SSL certificate (attempt {i+1}/{max_retries})...")
         
-        # Verify certbot is available
-        returncode, stdout, stderr = run_command("which certbot")
-        if returncode != 0:
-            print_error("Certbot not found. Please ensure it's installed correctly.")
-            sys.exit(1)
-        
         # Run certbot
-        cmd = f"certbot certonly --standalone --preferred-challenges http -d {domain} --email {email} --agree-tos -n"
+        domain_args = ' '.join(f"-d {domain}" for domain in domains)
+        cmd = f"certbot certonly --standalone --preferred-challenges http {domain_args} --email {email} --agree-tos -n --expand"
         returncode, stdout, stderr = run_command(cmd)
         
         if returncode == 0:
@@ -513,20 +1253,23 @@ def get_ssl_certificate(domain: str, email: str) -> None:
         
         if i < max_retries - 1:
             print_warning(f"Failed to obtain SSL certificate: {stderr}")
-            print_debug("Retrying in 5 seconds...")
-            time.sleep(5)
+            delay = backoff_delay(i)
+            print_debug(f"Retrying in {delay:.0f} seconds...")
+            time.sleep(delay)
         else:
-            print_error(f"Failed to obtain SSL certificate after {max_retries} attempts")
-            print_error(f"Error: {stderr}")
-            print_error("Please ensure:")
-            print_error("1. Your domain points to this server")
-            print_error("2. Port 80 is available")
-            print_error("3. You have a valid email address")
+            print_errors([
+                f"Failed to obtain SSL certificate after {max_retries} attempts",
+                f"Error: {stderr}",
+                "Please ensure:",
+                "1. Your domain points to this server",
+                "2. Port 80 is available",
+                "3. You have a valid email address"
+            ])
             sys.exit(1)
     
-    # Verify certificate files exist
-    cert_path = f"/etc/letsencrypt/live/{domain}/fullchain.pem"
-    key_path = f"/etc/letsencrypt/live/{domain}/privkey.pem"
+    # Verify certificate files exist (certbot names the lineage after the first domain)
+    cert_path = f"/etc/letsencrypt/live/{domains[0]}/fullchain.pem"
+    key_path = f"/etc/letsencrypt/live/{domains[0]}/privkey.pem"
     
     if not os.path.exists(cert_path) or not os.path.exists(key_path):
         print_error("SSL certificate files not found after successful generation")
@@ -534,224 +1277,225 @@ def get_ssl_certificate(domain: str, email: str) -> None:
     
     print_debug("SSL certificate files verified")
 
-def create_conduwuit_config(domain: str, turn_domain: str, secret_key: str, turn_secret: str) -> None:
+def link_or_copy(src: str, dst: Path) -> None:
+    """Hard-link src to dst, copying instead when they're on different filesystems"""
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        # Link the archive file behind the live/ symlink (os.link may link the symlink
+        # itself); a symlink would dangle inside the container, which only mounts certs/
+        os.link(os.path.realpath(src), dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def install_renewal_hook(domain: str) -> None:
+    """Have certbot refresh the certs links and restart the stack after this domain's renewals"""
+    # Renewal writes new archive files, so the hard links have to be re-pointed
+    live_dir = f"/etc/letsencrypt/live/{domain}"
+    certs_dir = INSTALL_DIR / "certs"
+    # Hooks in renewal-hooks/deploy run for every certificate on the host; certbot sets
+    # RENEWED_LINEAGE to the live directory of the one just renewed
+    lines = ["#!/bin/sh", f'[ "$RENEWED_LINEAGE" = {shlex.quote(live_dir)} ] || exit 0', "set -e"]
+    for name in ("fullchain.pem", "privkey.pem"):
+        src = shlex.quote(f"{live_dir}/{name}")
+        dst = shlex.quote(str(certs_dir / name))
+        lines.append(f"ln -fL {src} {dst} || cp -fL {src} {dst}")
+    lines.append(f"cd {shlex.quote(str(INSTALL_DIR))} && {shlex.join(compose_command())} restart conduwuit coturn")
+    os.makedirs(os.path.dirname(CERTBOT_DEPLOY_HOOK), exist_ok=True)
+    write_file(CERTBOT_DEPLOY_HOOK, "\n".join(lines) + "\n", mode=0o755)
+
+def parse_docker_size(size: str) -> float:
+    """Convert a Docker CLI size such as '1.2GB' or '512kB (40%)' to bytes (decimal units)"""
+    match = re.match(r"([\d.]+)\s*([kMGT]?B)", size)
+    if not match:
+        return 0
+    return float(match.group(1)) * DOCKER_SIZE_UNITS[match.group(2)]
+
+def prune_docker_if_needed(threshold: int = PRUNE_THRESHOLD) -> None:
+    """Run 'docker system prune -f' only when docker system df reports enough reclaimable space"""
+    returncode, stdout, stderr = run_command(["docker", "system", "df", "--format", "{{json .}}"])
+    if returncode == 0:
+        try:
+            reclaimable = sum(parse_docker_size(json.loads(line).get("Reclaimable", ""))
+                              for line in stdout.splitlines() if line.strip())
+        except ValueError:
+            reclaimable = threshold
+        if reclaimable < threshold:
+            print_debug("Little reclaimable Docker space, skipping prune")
+            return
+    run_command("docker system prune -f")
+
+def try_pull_image(image: str) -> bool:
+    """Try to pull a Docker image"""
+    # --quiet skips rendering per-layer progress into the captured output
+    returncode, stdout, stderr = run_command(["docker", "pull", "--quiet", image])
+    return returncode == 0
+
+def image_available(image: str) -> bool:
+    """Ask the registry whether an image exists, without downloading any layers"""
+    returncode, stdout, stderr = run_command(["docker", "manifest", "inspect", image])
+    return returncode == 0
+
+def pull_first_available(images: List[str]) -> Tuple[Optional[str], List[str]]:
+    """Pull the first image in the fallback list that succeeds
+    
+    Returns the pulled image (or None) and the images that failed, so callers
+    running this in the background can report them later.
+    """
+    # Probe every candidate at once so a missing tag costs one registry round trip
+    # in parallel rather than a failed pull in sequence; images the probe couldn't
+    # confirm are still tried afterwards in case the probe itself is unsupported
+    probes = [run_in_background(image_available, image) for image in images]
+    available = [probe.result() for probe in probes]
+    ordered = ([image for image, ok in zip(images, available) if ok]
+               + [image for image, ok in zip(images, available) if not ok])
+    for image in ordered:
+        if try_pull_image(image):
+            # Every preferred image ahead of the one used is reported as failed
+            return image, images[:images.index(image)]
+    return None, list(images)
+
+def start_image_pulls() -> Tuple[Future, Future]:
+    """Start pulling the Conduwuit and Coturn images concurrently"""
+    return (run_in_background(pull_first_available, CONDUWUIT_IMAGES),
+            run_in_background(pull_first_available, COTURN_IMAGES))
+
+def toml_string(value: str) -> str:
+    """Quote a value as a TOML basic string (JSON string escapes are valid TOML)"""
+    # Non-ASCII stays literal: JSON's surrogate-pair escapes are rejected by TOML
+    return json.dumps(value, ensure_ascii=False)
+
+def create_conduwuit_config(domain: str, turn_domain: str, secret_key: str, turn_secret: str,
+                            registration_token: str) -> None:
     """Create Conduwuit configuration file"""
     print_debug("Creating Conduwuit configuration...")
     
-    config = f"""[global]
-server_name = "{domain}"
-database_path = "/data/conduwuit.db"
-signing_key = "{secret_key}"
-enable_registration = false
-report_stats = false
-
-[turn]
-uris = [
-    "turn:{turn_domain}:3478",
-    "turns:{turn_domain}:5349"
-]
-secret = "{turn_secret}"
-ttl = 86400
-
-[tls]
-certs = "/certs/fullchain.pem"
-key = "/certs/privkey.pem"
-"""
+    config = CONDUWUIT_TEMPLATE.format_map({
+        "server_name": toml_string(domain),
+        "signing_key": toml_string(secret_key),
+        "turn_uri": toml_string(f"turn:{turn_domain}:3478"),
+        "turns_uri": toml_string(f"turns:{turn_domain}:5349"),
+        "turn_secret": toml_string(turn_secret),
+        "registration_token": toml_string(registration_token),
+    })
+    
+    # Catch a broken template before minutes of image pulls and health polling
+    if tomllib is not None:
+        try:
+            tomllib.loads(config)
+        except tomllib.TOMLDecodeError as e:
+            print_error(f"Generated Conduwuit configuration is invalid: {str(e)}")
+            sys.exit(1)
     
-    data_dir = Path("/opt/conduwuit/data")
+    data_dir = INSTALL_DIR / "data"
     data_dir.mkdir(parents=True, exist_ok=True)
     
-    # Save with .toml extension instead of .yaml
-    with open(data_dir / "conduwuit.toml", "w") as f:
-        f.write(config)
+    # Save with .toml extension instead of .yaml; it holds the signing key, so
+    # create it owner-only (the conduwuit container runs as root)
+    write_file(data_dir / "conduwuit.toml", config, mode=0o600)
+
+def close_registration() -> None:
+    """Turn off registration in conduwuit.toml and restart Conduwuit to apply it"""
+    print_debug("Disabling registration...")
+    config_path = INSTALL_DIR / "data" / "conduwuit.toml"
+    config = config_path.read_text()
+    write_file(config_path, config.replace("allow_registration = true", "allow_registration = false", 1),
+               mode=0o600)
+    run_compose("restart conduwuit")
+    if not wait_for_healthy_event("conduwuit", timeout=120):
+        print_warning("Conduwuit did not report healthy after disabling registration")
 
-def setup_conduwuit(domain: str, turn_domain: str, email: str, admin_user: str, admin_pass: str) -> None:
+def setup_conduwuit(domain: str, turn_domain: str, email: str, admin_user: str, admin_pass: str,
+                    image_pulls: Optional[Tuple[Future, Future]] = None) -> None:
     """Setup Conduwuit"""
-    install_dir = Path("/opt/conduwuit")
-    install_dir.mkdir(parents=True, exist_ok=True)
-    os.chdir(install_dir)
+    INSTALL_DIR.mkdir(parents=True, exist_ok=True)
     
     # Generate secrets
-    secret_key = ''.join(random.choices(string.hexdigits, k=32))
-    turn_secret = ''.join(random.choices(string.hexdigits, k=32))
+    secret_key = secrets.token_hex(16)
+    turn_secret = secrets.token_hex(16)
+    registration_token = secrets.token_hex(16)
     
     # Create Coturn config
     print_message("Creating Coturn configuration...")
-    with open("coturn.conf", "w") as f:
-        f.write(f"""use-auth-secret
-static-auth-secret={turn_secret}
-realm={turn_domain}
-# Security
-no-tcp-traffic
-no-multicast-peers
-# TLS support
-cert=/certs/fullchain.pem
-pkey=/certs/privkey.pem
-# Ports
-listening-port=3478
-tls-listening-port=5349
-min-port=49152
-max-port=49252
-# Logging
-verbose
-# Other
-stale-nonce=0
-# External IP (will be auto-detected)
-external-ip=auto
-""")
-    
-    # Create docker-compose.yml with improved configuration
-    print_message("Creating Docker Compose configuration...")
-    with open("docker-compose.yml", "w") as f:
-        f.write(f"""version: '3.8'
-services:
-  conduwuit:
-    image: ghcr.io/girlbossceo/conduwuit:v1.1.0
-    restart: unless-stopped
-    ports:
-      - "80:8000"
-      - "443:8443"
-    volumes:
-      - ./data:/data
-      - ./certs:/certs
-    environment:
-      - CONDUWUIT_CONFIG=/data/conduwuit.toml
-      - RUST_LOG=info,conduwuit=debug
-    healthcheck:
-      test: ["CMD", "curl", "-f", "http://localhost:8000/_matrix/client/versions"]
-      interval: 10s
-      timeout: 5s
-      retries: 5
-      start_period: 30s
-    logging:
-      driver: "json-file"
-      options:
-        max-size: "10m"
-        max-file: "3"
-
-  coturn:
-    image: coturn/coturn:4.6.2
-    restart: unless-stopped
-    network_mode: host
-    volumes:
-      - ./coturn.conf:/etc/coturn/turnserver.conf:ro
-      - ./certs:/certs:ro
-    ports:
-      - "3478:3478/udp"
-      - "3478:3478/tcp"
-      - "5349:5349/udp"
-      - "5349:5349/tcp"
-      - "49152-49252:49152-49252/udp"
-    depends_on:
-      - conduwuit
-    logging:
-      driver: "json-file"
-      options:
-        max-size: "10m"
-        max-file: "3"
-""")
+    write_file(INSTALL_DIR / "coturn.conf", COTURN_TEMPLATE.format_map({"turn_secret": turn_secret, "turn_domain": turn_domain}))
     
     # Create Conduwuit config
-    create_conduwuit_config(domain, turn_domain, secret_key, turn_secret)
+    create_conduwuit_config(domain, turn_domain, secret_key, turn_secret, registration_token)
+    
+    # Pull images in the background so the download overlaps certificate issuance,
+    # unless main() already started them right after Docker came up
+    if image_pulls is None:
+        print_debug("Pulling Docker images...")
+        image_pulls = start_image_pulls()
+    conduwuit_pull, coturn_pull = image_pulls
     
-    # Get SSL certificates for both domains
-    get_ssl_certificate(domain, email)
-    get_ssl_certificate(turn_domain, email)
+    # Get one SSL certificate covering both domains
+    get_ssl_certificate([domain, turn_domain], email)
     
-    # Copy SSL certificates
-    print_debug("Copying SSL certificates...")
+    # Link SSL certificates into the bind-mounted certs directory
+    print_debug("Linking SSL certificates...")
     try:
-        certs_dir = Path("certs")
+        certs_dir = INSTALL_DIR / "certs"
         certs_dir.mkdir(exist_ok=True)
-        shutil.copy(f"/etc/letsencrypt/live/{domain}/fullchain.pem", certs_dir)
-        shutil.copy(f"/etc/letsencrypt/live/{domain}/privkey.pem", certs_dir)
+        for name in ("fullchain.pem", "privkey.pem"):
+            link_or_copy(f"/etc/letsencrypt/live/{domain}/{name}", certs_dir / name)
+            os.chmod(certs_dir / name, 0o644 if name == "fullchain.pem" else 0o600)
         certs_dir.chmod(0o755)
+        install_renewal_hook(domain)
     except Exception as e:
-        print_error(f"Failed to copy SSL certificates: {str(e)}")
+        print_error(f"Failed to link SSL certificates: {str(e)}")
         sys.exit(1)
     
-    # Start services with improved error handling
-    print_message("Starting services...")
-    
-    # Define alternative images to try
-    conduwuit_images = [
-        "ghcr.io/girlbossceo/conduwuit:v1.1.0",  # Try specific version first
-        "ghcr.io/girlbossceo/conduwuit:latest",  # Then latest
-        "ghcr.io/girlbossceo/conduwuit:stable",  # Then stable
-        "conduwuit/conduwuit:latest"             # Fallback to alternative repo
-    ]
-    
-    coturn_images = [
-        "coturn/coturn:4.6.2",    # Try specific version first
-        "coturn/coturn:latest",   # Then latest
-        "coturn/coturn:alpine"    # Then alpine version
-    ]
-    
-    def try_pull_image(image: str) -> bool:
-        """Try to pull a Docker image"""
-        print_debug(f"Attempting to pull image: {image}")
-        returncode, stdout, stderr = run_command(f"docker pull {image}")
-        return returncode == 0
-    
-    def update_compose_image(service: str, image: str):
-        """Update image in docker-compose.yml"""
-        with open("docker-compose.yml", "r") as f:
-            content = f.read()
-        
-        # Create pattern based on service
-        if service == "conduwuit":
-            old_pattern = r'image: ghcr.io/girlbossceo/conduwuit:[^\n]+'
-        else:
-            old_pattern = r'image: coturn/coturn:[^\n]+'
-        
-        import re
-        new_content = re.sub(old_pattern, f'image: {image}', content)
-        
-        with open("docker-compose.yml", "w") as f:
-            f.write(new_content)
+    print_debug("Waiting for Docker image pulls to finish...")
+    conduwuit_image, conduwuit_failed = conduwuit_pull.result()
+    coturn_image, coturn_failed = coturn_pull.result()
     
-    # Try pulling images with fallbacks
-    print_debug("Pulling Docker images...")
+    for image in conduwuit_failed:
+        print_warning(f"Failed to pull Conduwuit image: {image}")
+    for image in coturn_failed:
+        print_warning(f"Failed to pull Coturn image: {image}")
     
-    # Try Conduwuit images
-    conduwuit_success = False
-    for image in conduwuit_images:
-        if try_pull_image(image):
-            print_message(f"Successfully pulled Conduwuit image: {image}")
-            update_compose_image("conduwuit", image)
-            conduwuit_success = True
-            break
-        else:
-            print_warning(f"Failed to pull Conduwuit image: {image}")
+    # Start services with improved error handling
+    print_message("Starting services...")
     
-    if not conduwuit_success:
+    if conduwuit_image is None:
         print_error("Failed to pull any Conduwuit image")
         print_error("Please check your internet connection and Docker registry access")
         sys.exit(1)
+    print_message(f"Successfully pulled Conduwuit image: {conduwuit_image}")
     
-    # Try Coturn images
-    coturn_success = False
-    for image in coturn_images:
-        if try_pull_image(image):
-            print_message(f"Successfully pulled Coturn image: {image}")
-            update_compose_image("coturn", image)
-            coturn_success = True
-            break
-        else:
-            print_warning(f"Failed to pull Coturn image: {image}")
-    
-    if not coturn_success:
+    if coturn_image is None:
         print_error("Failed to pull any Coturn image")
         print_error("Please check your internet connection and Docker registry access")
         sys.exit(1)
+    print_message(f"Successfully pulled Coturn image: {coturn_image}")
+    
+    # Create docker-compose.yml once the images are known
+    print_message("Creating Docker Compose configuration...")
+    write_file(INSTALL_DIR / "docker-compose.yml", COMPOSE_TEMPLATE.format_map({
+        "conduwuit_image": conduwuit_image,
+        "coturn_image": coturn_image,
+    }))
+    returncode, stdout, stderr = run_compose("config -q")
+    if returncode != 0:
+        print_error(f"Generated docker-compose.yml is invalid: {stderr.strip()}")
+        sys.exit(1)
     
     # Stop any existing containers
     print_debug("Stopping any existing containers...")
-    run_command("docker-compose down")
+    run_compose("down")
     
     # Start services with improved error handling
     print_debug("Starting services...")
-    returncode, stdout, stderr = run_command("docker-compose up -d")
+    max_wait_time = 180  # 3 minutes timeout
+    # Compose v2 can block until every healthcheck passes; releases without --wait reject
+    # the flag without starting anything, so only those fall back to the polling loop below
+    returncode, stdout, stderr = run_compose(["up", "-d", "--wait",
+                                              "--wait-timeout", str(max_wait_time)])
+    wait_supported = not (returncode != 0 and COMPOSE_UNKNOWN_FLAG_PATTERN.search(stderr))
+    if not wait_supported:
+        returncode, stdout, stderr = run_compose("up -d")
+    services_ready = wait_supported and returncode == 0
     if returncode != 0:
         print_error("Failed to start services")
         print_error(f"Error: {stderr}")
@@ -761,225 +1505,223 @@ services:
         if "port is already allocated" in stderr:
             print_warning("Port conflict detected. Checking for conflicting services...")
             for port in [80, 443, 3478, 5349]:
-                run_command(f"lsof -i :{port}")
+                run_command(["lsof", "-i", f":{port}"])
         elif "no space left on device" in stderr:
             print_warning("Disk space issue detected. Cleaning up Docker system...")
             run_command("docker system prune -f")
         elif "permission denied" in stderr:
             print_warning("Permission issue detected. Fixing directory permissions...")
-            run_command("chmod -R 755 /opt/conduwuit")
-            run_command("chown -R root:root /opt/conduwuit")
+            reset_permissions(INSTALL_DIR)
+    
+    if services_ready:
+        print_message("Services are healthy and responding")
+        return secret_key, turn_secret, registration_token
     
     # Wait for services with improved health checking
     print_debug("Waiting for services to be ready...")
-    max_wait_time = 180  # 3 minutes timeout
-    check_interval = 5
-    start_time = time.time()
+    check_interval = 1
     
     def check_services():
-        """Check if services are running and healthy with detailed diagnostics"""
-        # Check if containers are running
-        returncode, stdout, stderr = run_command("docker-compose ps -a")
-        if "Exit" in stdout or "Restarting" in stdout:
-            print_warning("Containers are not running properly:")
-            print(stdout)
-            
-            # Get detailed container status
-            returncode, stdout, stderr = run_command("docker ps -a")
-            print_debug("Detailed container status:")
-            print(stdout)
-            
-            # Check container logs
-            returncode, stdout, stderr = run_command("docker-compose logs --tail=50")
-            print_debug("Recent container logs:")
-            print(stdout)
-            
-            return False
-        
-        # Check Conduwuit container specifically
-        returncode, stdout, stderr = run_command("docker-compose ps conduwuit")
-        if "Up" not in stdout or "healthy" not in stdout.lower():
-            print_warning("Conduwuit container is not healthy")
-            
-            # Get Conduwuit logs
-            returncode, logs, stderr = run_command("docker-compose logs conduwuit --tail=50")
-            if logs:
-                print_debug("Conduwuit logs:")
-                print(logs)
-                
-                # Check for specific error patterns
-                if "error" in logs.lower():
-                    print_warning("Found errors in Conduwuit logs")
-                    if "database" in logs.lower():
-                        print_debug("Database issue detected, attempting to fix...")
-                        run_command("docker-compose restart conduwuit")
-                    elif "config" in logs.lower():
-                        print_debug("Configuration issue detected")
-                        print_debug("Please check your configuration file for errors")
-            
-            return False
-        
-        # Try to access the health endpoint
-        returncode, stdout, stderr = run_command("curl -s -o /dev/null -w '%{http_code}' http://localhost:8000/_matrix/client/versions")
-        if returncode != 0 or stdout.strip() != "200":
-            print_warning("Health endpoint is not responding")
-            return False
-        
-        return True
-    
-    while time.time() - start_time < max_wait_time:
-        elapsed = int(time.time() - start_time)
-        remaining = max_wait_time - elapsed
-        print_progress(elapsed, max_wait_time, 
-                      prefix="Waiting for services:", 
-                      suffix=f"Time remaining: {remaining}s")
-        
-        if check_services():
-            print_message("\nServices are healthy and responding")
-            break
-        
-        # Show detailed status and troubleshooting options after half timeout
-        if elapsed > max_wait_time // 2:
-            print_debug("\nDetailed service status:")
-            run_command("docker-compose ps")
-            run_command("docker-compose logs --tail=20")
-            
-            print_warning("\nServices taking longer than expected to start")
-            print("Troubleshooting options:")
-            print("1. Continue waiting")
-            print("2. View detailed logs")
-            print("3. Attempt automatic fix")
-            print("4. Cancel installation")
-            
-            choice = input("\nChoose an option (1-4): ").strip()
-            
-            if choice == "2":
-                print_debug("\nFull container logs:")
-                run_command("docker-compose logs")
-                input("\nPress Enter to continue...")
-            elif choice == "3":
-                print_debug("Attempting automatic fix...")
-                run_command("docker-compose down")
-                run_command("docker system prune -f")
-                run_command("docker-compose up -d")
-            elif choice == "4":
-                print_error("Installation cancelled by user")
-                sys.exit(1)
-        
-        time.sleep(check_interval)
-    else:
-        print_error("\nService failed to become healthy within timeout")
-        print_error("Detailed diagnostics:")
-        run_command("docker-compose ps")
-        run_command("docker-compose logs")
+        """Check that no container failed, Conduwuit is healthy and its endpoint answers"""
+        # Runs under the spinner, so it stays silent; the failure path prints the diagnostics
+        return (not compose_containers_failed() and compose_service_healthy("conduwuit")
+                and check_health_endpoint())
+    
+    # Same wait, troubleshooting menu and fixes as the other long waits. A failed
+    # 'up --wait' already gave the healthchecks max_wait_time, so it isn't repeated
+    if wait_supported or not wait_for_operation(
+        "Conduwuit services to start",
+        check_services,
+        timeout=max_wait_time,
+        check_interval=check_interval,
+        logs_args="logs --tail=50"
+    ):
+        print_error("Service failed to become healthy within timeout")
+        print_service_diagnostics()
         sys.exit(1)
+    print_message("Services are healthy and responding")
     
-    return secret_key, turn_secret
+    return secret_key, turn_secret, registration_token
 
 class InstallationProgress:
     def __init__(self):
         self.current_step = 0
         self.total_steps = 10  # Total number of main installation steps
         self.current_operation = ""
-        self.start_time = datetime.datetime.now()
-        self._stop_spinner = False
+        self.start_time = time.monotonic()
+        # One spinner thread for the whole run; it sleeps on the event while no spinner is shown
+        self._spinning = threading.Event()
+        self._spinner_lock = threading.Lock()
+        self._spinner_thread = None
+        self._spinner_frames = []
         self.spinner_chars = "⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"
+        # A frame every quarter second still reads as motion at a fraction of the writes
+        self.spinner_interval = 0.25
         self.spinner_idx = 0
+        self.completed_steps = self._load_state()
         
     def update_step(self, step: int, operation: str):
+        # Steps run in order, so moving on means the previous one finished
+        if step > self.current_step > 0:
+            self._save_step(self.current_step)
         self.current_step = step
         self.current_operation = operation
         self.show_progress()
     
+    def step_done(self, step: int) -> bool:
+        """Return whether a previous run recorded this step as completed"""
+        return str(step) in self.completed_steps
+    
+    def _load_state(self) -> Dict[str, float]:
+        try:
+            with open(INSTALL_STATE_FILE) as f:
+                return json.load(f).get("completed", {})
+        except (OSError, ValueError, AttributeError):
+            return {}
+    
+    def _save_step(self, step: int):
+        self.completed_steps[str(step)] = time.time()
+        try:
+            os.makedirs(os.path.dirname(INSTALL_STATE_FILE), exist_ok=True)
+            write_file(INSTALL_STATE_FILE, json.dumps({"completed": self.completed_steps}))
+        except OSError as e:
+            print_warning(f"Could not record installation progress (non-fatal): {str(e)}")
+    
+    def clear_state(self):
+        """Forget the recorded steps once an installation has finished"""
+        self.completed_steps = {}
+        try:
+            os.remove(INSTALL_STATE_FILE)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print_warning(f"Could not remove {INSTALL_STATE_FILE} (non-fatal): {str(e)}")
+    
     def show_progress(self):
-        elapsed = datetime.datetime.now() - self.start_time
+        elapsed = int(time.monotonic() - self.start_time)
         percent = (self.current_step / self.total_steps) * 100
         print(f"\r{Colors.BLUE}[*]{Colors.NC} Progress: [{self.current_step}/{self.total_steps}] {percent:.1f}% - {self.current_operation}")
-        print(f"{Colors.BLUE}[*]{Colors.NC} Time elapsed: {str(elapsed).split('.')[0]}")
+        print(f"{Colors.BLUE}[*]{Colors.NC} Time elapsed: {elapsed // 3600}:{elapsed // 60 % 60:02d}:{elapsed % 60:02d}")
 
     def start_spinner(self, message: str):
-        self._stop_spinner = False
-        threading.Thread(target=self._spin, args=(message,), daemon=True).start()
+        # Render every frame for this message once; the spinner thread only writes them
+        self._spinner_frames = [f"\r{Colors.BLUE}[{char}]{Colors.NC} {message}" for char in self.spinner_chars]
+        if self._spinner_thread is None:
+            self._spinner_thread = threading.Thread(target=self._spin, daemon=True)
+            self._spinner_thread.start()
+        self._spinning.set()
     
     def stop_spinner(self):
-        self._stop_spinner = True
-        time.sleep(0.1)  # Give spinner time to stop
+        if not self._spinning.is_set():
+            return
+        # Taking the lock guarantees no frame is printed after the newline below
+        with self._spinner_lock:
+            self._spinning.clear()
         print()  # New line after spinner stops
     
-    def _spin(self, message: str):
-        while not self._stop_spinner:
-            print(f"\r{Colors.BLUE}[{self.spinner_chars[self.spinner_idx]}]{Colors.NC} {message}", end="")
-            self.spinner_idx = (self.spinner_idx + 1) % len(self.spinner_chars)
-            time.sleep(0.1)
+    def _spin(self):
+        while True:
+            self._spinning.wait()
+            with self._spinner_lock:
+                if self._spinning.is_set():
+                    frames = self._spinner_frames
+                    sys.stdout.write(frames[self.spinner_idx % len(frames)])
+                    sys.stdout.flush()
+                    self.spinner_idx = (self.spinner_idx + 1) % len(frames)
+            time.sleep(self.spinner_interval)
 
 class TroubleshootingMenu:
     def __init__(self):
         self.progress = None
+        # When _fix_conduwuit last read the logs, so repeat attempts only read new lines
+        self._last_log_check = None
+        # Checked in order; the first keyword found in the operation name picks the fix
+        self._fixers = (
+            ("package manager", self._fix_package_manager),
+            ("docker", self._fix_docker),
+            ("certbot", self._fix_certbot),
+            ("conduwuit", self._fix_conduwuit),
+        )
     
     def set_progress(self, progress: InstallationProgress):
         self.progress = progress
     
-    def show_menu(self, context: str, logs_cmd: str = None) -> bool:
+    def show_menu(self, context: str, logs_args: str = None) -> bool:
         """Show troubleshooting menu and return whether to continue"""
-        print_warning(f"\nOperation taking longer than expected: {context}")
-        print("\nTroubleshooting Options:")
-        print("1. Continue waiting")
-        print("2. View detailed diagnostics")
-        print("3. Try automatic fixes")
-        print("4. Manual intervention")
-        print("5. Cancel installation")
-        
+        # Loop rather than recurse, so repeated visits don't stack frames holding old output
+        show_options = True
         while True:
+            if show_options:
+                print_warning(f"\nOperation taking longer than expected: {context}")
+                print("\nTroubleshooting Options:")
+                print("1. Continue waiting")
+                print("2. View detailed diagnostics")
+                print("3. Try automatic fixes")
+                print("4. Manual intervention")
+                print("5. Cancel installation")
+            # Options are shown again after an action, but not after a bad or declined choice
+            show_options = True
+            
             choice = input("\nChoose an option (1-5): ").strip()
             
             if choice == "1":
                 return True
             elif choice == "2":
-                self._show_diagnostics(context, logs_cmd)
-                return self.show_menu(context, logs_cmd)
+                self._show_diagnostics(context, logs_args)
             elif choice == "3":
                 if self._attempt_fix(context):
                     print_message("Automatic fix was successful")
                     return True
                 print_warning("Automatic fix was not successful")
-                return self.show_menu(context, logs_cmd)
             elif choice == "4":
                 self._show_manual_intervention()
-                return self.show_menu(context, logs_cmd)
             elif choice == "5":
                 if input("Are you sure you want to cancel? (y/N): ").lower() == 'y':
                     print_error("Installation cancelled by user")
                     sys.exit(1)
+                show_options = False
             else:
                 print_error("Invalid choice")
+                show_options = False
     
-    def _show_diagnostics(self, context: str, logs_cmd: str = None):
+    def _show_diagnostics(self, context: str, logs_args: str = None):
         """Show relevant logs and diagnostics"""
         print_debug("\nGathering diagnostic information...")
         
+        # The commands are independent, so gather them all at once (docker info alone
+        # can take a while) and print the captured output in a fixed order
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            status = executor.submit(run_compose, "ps")
+            logs = executor.submit(run_compose, logs_args) if logs_args else None
+            disk_usage = executor.submit(run_command, "docker system df")
+            docker_info = executor.submit(run_command, "docker info")
+        
+        def show(future: Future) -> None:
+            returncode, stdout, stderr = future.result()
+            sys.stdout.write(stdout + stderr)
+        
         # Show container status
         print_debug("\nContainer Status:")
-        run_command("docker-compose ps")
+        show(status)
         
         # Show container logs
-        if logs_cmd:
+        if logs is not None:
             print_debug(f"\nContainer Logs:")
-            returncode, stdout, stderr = run_command(logs_cmd)
-            print(stdout)
+            show(logs)
         
         # Show system resources
         print_debug("\nSystem Resources:")
-        run_command("free -h")  # Memory usage
-        run_command("df -h")    # Disk usage
+        print_system_resources()
         
         # Show Docker system info
         print_debug("\nDocker System Information:")
-        run_command("docker system df")  # Docker disk usage
-        run_command("docker info")       # Docker system info
+        show(disk_usage)   # Docker disk usage
+        show(docker_info)  # Docker system info
         
         # Show network status
         print_debug("\nNetwork Status:")
-        run_command("netstat -tulpn | grep -E ':(80|443|3478|5349)'")
+        for proto, address, port in listening_sockets({80, 443, 3478, 5349}):
+            print(f"{proto:<5} {address}:{port}")
         
         input("\nPress Enter to continue...")
     
@@ -991,16 +1733,17 @@ class TroubleshootingMenu:
         print("   - Check /opt/conduwuit/coturn.conf")
         print("   - Check /opt/conduwuit/docker-compose.yml")
         
-        print("\n2. Common commands:")
-        print("   - View logs: docker-compose logs")
-        print("   - Restart services: docker-compose restart")
-        print("   - Rebuild containers: docker-compose up -d --force-recreate")
+        compose = " ".join(compose_command())
+        print(f"\n2. Common commands (run in {INSTALL_DIR}):")
+        print(f"   - View logs: {compose} logs")
+        print(f"   - Restart services: {compose} restart")
+        print(f"   - Rebuild containers: {compose} up -d --force-recreate")
         print("   - Clean Docker system: docker system prune")
         
         print("\n3. Check ports:")
         print("   - Required ports: 80, 443 (Matrix server)")
         print("   - TURN ports: 3478, 5349, 49152-49252")
-        print("   - Command: netstat -tulpn")
+        print("   - Command: ss -tulpn")
         
         print("\n4. Check SSL certificates:")
         print("   - Location: /opt/conduwuit/certs/")
@@ -1012,48 +1755,37 @@ class TroubleshootingMenu:
         """Attempt to automatically fix common issues"""
         print_debug(f"Attempting to fix issues with {context}...")
         
-        if "package manager" in context.lower():
-            return self._fix_package_manager()
-        elif "docker" in context.lower():
-            return self._fix_docker()
-        elif "certbot" in context.lower():
-            return self._fix_certbot()
-        elif "conduwuit" in context.lower():
-            return self._fix_conduwuit()
+        context = context.lower()
+        for keyword, fix in self._fixers:
+            if keyword in context:
+                return fix()
         
         # Try general fixes
         print_debug("Attempting general fixes...")
         
         # Fix permissions
-        run_command("chmod -R 755 /opt/conduwuit")
-        run_command("chown -R root:root /opt/conduwuit")
+        reset_permissions(INSTALL_DIR)
         
         # Clean Docker system
-        run_command("docker system prune -f")
+        prune_docker_if_needed()
         
         # Restart services
-        run_command("docker-compose down")
-        run_command("docker-compose up -d --force-recreate")
+        run_compose("down")
+        run_compose("up -d --force-recreate")
         
-        # Wait a bit and check if it worked
-        time.sleep(10)
-        returncode, stdout, stderr = run_command("docker-compose ps")
-        return "Exit" not in stdout and "Restarting" not in stdout
+        # Wait for the healthcheck and check if it worked
+        wait_for_healthy_event("conduwuit", timeout=30)
+        return not compose_containers_failed()
     
     def _fix_package_manager(self) -> bool:
         """Fix common package manager issues"""
         print_debug("Attempting to fix package manager...")
         
-        # Kill stuck processes
-        processes = ["unattended-upgr", "apt-get", "dpkg"]
-        for proc in processes:
-            kill_stuck_process(proc)
-        
-        # Remove lock files
-        check_and_fix_locks()
+        # Kill stuck processes; their locks are released as they exit
+        kill_stuck_processes(["unattended-upgr", "apt-get", "dpkg"])
         
         # Reconfigure packages
-        run_command("dpkg --configure -a")
+        run_command(["dpkg", "--configure", "-a"], env=NONINTERACTIVE_ENV)
         
         return True
     
@@ -1063,19 +1795,17 @@ class TroubleshootingMenu:
         
         # Restart Docker daemon
         run_command("systemctl restart docker")
-        time.sleep(2)
         
-        # Verify Docker is running
-        returncode, stdout, stderr = run_command("systemctl is-active docker")
-        if returncode != 0:
+        # Verify Docker is running by connecting to its socket in-process, as soon as it's up
+        if not wait_until(docker_socket_ready, timeout=30):
             return False
         
         # Clean up Docker system
-        run_command("docker system prune -f")
+        prune_docker_if_needed()
         
         # Recreate containers
-        run_command("docker-compose down")
-        run_command("docker-compose up -d --force-recreate")
+        run_compose("down")
+        run_compose("up -d --force-recreate")
         
         return True
     
@@ -1083,107 +1813,113 @@ class TroubleshootingMenu:
         """Fix common Certbot issues"""
         print_debug("Attempting to fix Certbot...")
         
-        # Reinstall Certbot
+        # Reinstall Certbot; snap remove only returns once the removal change is done
         run_command("snap remove certbot")
-        time.sleep(2)
         run_command("snap install --classic certbot")
-        run_command("ln -sf /snap/bin/certbot /usr/bin/certbot")
         
         # Verify installation
-        returncode, stdout, stderr = run_command("which certbot")
-        return returncode == 0
+        if not os.access(CERTBOT_SNAP_PATH, os.X_OK):
+            return False
+        link_certbot()
+        return True
     
     def _fix_conduwuit(self) -> bool:
         """Fix common Conduwuit issues"""
         print_debug("Attempting to fix Conduwuit...")
         
         # Check container status
-        returncode, stdout, stderr = run_command("docker-compose ps")
-        if "Exit" in stdout or "Restarting" in stdout:
+        if compose_containers_failed():
             print_debug("Containers are not running properly, attempting fixes...")
             
+            # Check logs for specific issues, before the prune removes the stopped container
+            log_args = ["logs", "conduwuit"]
+            if self._last_log_check is None:
+                log_args.append("--tail=50")
+            else:
+                log_args.append(f"--since={int(self._last_log_check)}")
+            self._last_log_check = time.time()
+            returncode, stdout, stderr = run_compose(log_args)
+            
             # Clean up Docker system
             print_debug("Cleaning up Docker system...")
-            run_command("docker system prune -f")
-            
-            # Check logs for specific issues
-            returncode, stdout, stderr = run_command("docker-compose logs conduwuit --tail=50")
-            logs = stdout.lower()
+            prune_docker_if_needed()
             
-            if "error" in logs or "panic" in logs:
+            if LOG_ERROR_PATTERN.search(stdout):
                 print_debug("Found errors in logs:")
                 print(stdout)
                 
-                # Try fixes based on error patterns
-                if "permission denied" in logs:
+                # Try the fix for the first known issue that appears in the logs
+                issue = LOG_ISSUE_PATTERN.search(stdout)
+                issue = issue.group(0).lower() if issue else None
+                if issue == "permission denied":
                     print_debug("Fixing permissions...")
-                    run_command("chmod -R 755 /opt/conduwuit/data")
-                    run_command("chown -R root:root /opt/conduwuit/data")
-                elif "connection refused" in logs:
+                    reset_permissions(INSTALL_DIR / "data")
+                elif issue == "connection refused":
                     print_debug("Network issue detected, recreating network...")
-                    run_command("docker-compose down")
+                    run_compose("down")
                     run_command("docker network prune -f")
-                    run_command("docker-compose up -d")
-                elif "no such file or directory" in logs:
+                    run_compose("up -d")
+                elif issue == "no such file or directory":
                     print_debug("Creating missing directories...")
-                    run_command("mkdir -p /opt/conduwuit/data")
-                    run_command("mkdir -p /opt/conduwuit/certs")
-                    run_command("chmod -R 755 /opt/conduwuit")
-                elif "config" in logs:
+                    (INSTALL_DIR / "data").mkdir(parents=True, exist_ok=True)
+                    (INSTALL_DIR / "certs").mkdir(exist_ok=True)
+                    reset_permissions(INSTALL_DIR)
+                elif issue == "config":
                     print_debug("Configuration issue detected...")
                     print_debug("Please check your configuration files for errors")
             
             # Recreate containers
             print_debug("Recreating containers...")
-            run_command("docker-compose down")
-            run_command("docker-compose up -d --force-recreate")
+            run_compose("down")
+            run_compose("up -d --force-recreate")
             
-            # Wait and check status
-            time.sleep(10)
-            returncode, stdout, stderr = run_command("docker-compose ps")
-            if "Exit" in stdout or "Restarting" in stdout:
+            # Wait for the healthcheck to pass instead of sleeping a fixed time
+            wait_for_healthy_event("conduwuit", timeout=30)
+            if compose_containers_failed():
                 print_warning("Containers still not running properly after fixes")
                 return False
         
         # Verify service is responding
         print_debug("Checking if service is responding...")
-        returncode, stdout, stderr = run_command("curl -s -o /dev/null -w '%{http_code}' http://localhost:8000/_matrix/client/versions")
-        return returncode == 0 and stdout.strip() == "200"
+        return check_health_endpoint()
 
 # Initialize global progress tracker and troubleshooting menu
 progress = InstallationProgress()
 troubleshoot = TroubleshootingMenu()
 troubleshoot.set_progress(progress)
 
-def wait_for_operation(operation: str, check_func, timeout: int = 60, check_interval: int = 5, logs_cmd: str = None) -> bool:
+def wait_for_operation(operation: str, check_func, timeout: int = 60, check_interval: int = 5, logs_args: str = None) -> bool:
     """Wait for an operation to complete with progress tracking and troubleshooting"""
-    start_time = time.time()
+    start_time = time.monotonic()
     progress.start_spinner(f"Waiting for {operation}...")
+    # Poll densely at first, when a quick success is most likely, backing off to check_interval
+    interval = 0.1
+    menu_shown = False
     
-    while time.time() - start_time < timeout:
+    while time.monotonic() - start_time < timeout:
         if check_func():
             progress.stop_spinner()
             return True
             
-        if time.time() - start_time > timeout // 2:  # Show menu after half the timeout
+        # Show menu once, after half the timeout; "continue waiting" then polls out the rest
+        if not menu_shown and time.monotonic() - start_time > timeout // 2:
+            menu_shown = True
             progress.stop_spinner()
             
             # Show current status
             print_debug("\nCurrent Status:")
-            returncode, stdout, stderr = run_command("docker-compose ps")
-            print(stdout)
+            run_compose("ps", capture=False)
             
-            returncode, stdout, stderr = run_command("docker-compose logs --tail=20")
-            if stdout:
-                print_debug("Recent logs:")
-                print(stdout)
+            print_debug("Recent logs:")
+            run_compose("logs --tail=20", capture=False)
             
-            if not troubleshoot.show_menu(operation, logs_cmd):
+            if not troubleshoot.show_menu(operation, logs_args):
                 return False
                 
             progress.start_spinner(f"Continuing to wait for {operation}...")
             
-        time.sleep(check_interval)
+        time.sleep(interval * random.uniform(0.8, 1.2))
+        interval = min(interval * 2, check_interval)
     
     progress.stop_spinner()
     return False
@@ -1198,87 +1934,134 @@ def main():
         progress.update_step(1, "Checking system requirements")
         check_root()
         check_system()
+        # A run that failed after starting the stack leaves it holding the ports it needs
+        if progress.completed_steps:
+            stop_previous_stack()
         check_ports()
         
+        # Start the IP lookup and Docker apt key (or install script) fetch now; they overlap
+        # with the prompts. They run on daemon threads, so declining a prompt or pressing
+        # Ctrl-C exits straight away instead of waiting for them
+        # Steps a previous run finished are skipped when their result is still in place
+        packages_done = progress.step_done(3) and find_tool("certbot", refresh=True) is not None
+        compose_done = progress.step_done(5) and os.access(DOCKER_COMPOSE_TARGET, os.X_OK)
+        
+        public_ip = run_in_background(lookup_public_ip)
+        distro = read_os_release().get("ID")
+        docker_key = None
+        docker_script = None
+        if distro in ("ubuntu", "debian"):
+            if not packages_done:
+                docker_key = run_in_background(fetch_url, DOCKER_APT_KEY_URL.format(distro=distro))
+        elif find_tool("docker") is None:
+            # No Docker apt repository here, so the install script will be needed
+            docker_script = run_in_background(fetch_url, DOCKER_SCRIPT_URL)
+        
+        # Get user input and verify DNS before any packages are touched, so a
+        # misconfigured domain is caught in seconds rather than after the install
+        progress.update_step(2, "Configuring installation")
+        matrix_domain, turn_domain, email, admin_user, admin_pass = get_user_input(public_ip)
+        
         # Package installation
-        progress.update_step(2, "Installing required packages")
-        install_packages()
+        progress.update_step(3, "Installing required packages")
+        if packages_done:
+            print_message("Required packages already installed by a previous run, skipping")
+        else:
+            install_packages(docker_key)
         
         # Docker installation
-        progress.update_step(3, "Installing Docker")
-        install_docker()
+        progress.update_step(4, "Installing Docker")
+        install_docker(docker_script)
         
-        # Docker Compose installation
-        progress.update_step(4, "Installing Docker Compose")
-        install_docker_compose()
+        # Docker is up: pull the images in the background while the rest of the setup runs
+        image_pulls = start_image_pulls()
         
-        # Get user input
-        progress.update_step(5, "Configuring installation")
-        matrix_domain, turn_domain, email, admin_user, admin_pass = get_user_input()
+        # Docker Compose installation
+        progress.update_step(5, "Installing Docker Compose")
+        # Both the Docker apt repository and get-docker.sh install the compose plugin, so
+        # the standalone binary is normally only needed when that plugin is missing
+        if compose_command() == ("docker", "compose"):
+            print_message("Docker Compose plugin is available, skipping the standalone download")
+        elif compose_done:
+            print_message("Docker Compose already installed by a previous run, skipping")
+        else:
+            install_docker_compose()
         
         # Setup Conduwuit
         progress.update_step(6, "Setting up Conduwuit")
-        secret_key, turn_secret = setup_conduwuit(matrix_domain, turn_domain, email, admin_user, admin_pass)
+        secret_key, turn_secret, registration_token = setup_conduwuit(matrix_domain, turn_domain, email, admin_user, admin_pass, image_pulls)
         
         # Wait for services
         progress.update_step(7, "Waiting for services to start")
         def check_services():
-            returncode, stdout, stderr = run_command("docker-compose ps -a")
-            if "Exit" in stdout or "Restarting" in stdout:
-                return False
-            returncode, stdout, stderr = run_command("curl -s -o /dev/null -w '%{http_code}' http://localhost:8000/_matrix/client/versions")
-            return returncode == 0 and stdout.strip() == "200"
-        
-        if not wait_for_operation(
+            # Container state from the Engine API and the endpoint over a kept-alive connection
+            return not compose_containers_failed() and check_health_endpoint()
+        
+        # Sleep on Docker's health events instead of polling; the polling loop with its
+        # troubleshooting menu only runs if the service isn't healthy in time
+        print_debug("Waiting for Conduwuit to report healthy...")
+        if wait_for_healthy_event("conduwuit", timeout=120) and check_health_endpoint():
+            print_message("Services are healthy")
+        elif not wait_for_operation(
             "services to become healthy",
             check_services,
             timeout=120,
             check_interval=5,
-            logs_cmd="docker-compose logs --tail=50"
+            logs_args="logs --tail=50"
         ):
             print_error("Services failed to start properly")
             sys.exit(1)
         
         # Create admin user
         progress.update_step(8, "Creating admin user")
+        admin_status = {}
         def check_admin_user():
-            cmd = f"docker-compose exec -T conduwuit register_new_matrix_user -c /data/conduwuit.toml -u {admin_user} -p {admin_pass} -a"
-            returncode, stdout, stderr = run_command(cmd)
-            return returncode == 0
+            # Conduwuit makes the first account registered on the server an admin
+            admin_status["status"] = register_matrix_user(admin_user, admin_pass, registration_token)
+            return bool(admin_status["status"])
         
         if not wait_for_operation(
             "admin user creation",
             check_admin_user,
             timeout=60,
             check_interval=5,
-            logs_cmd="docker-compose logs conduwuit"
+            logs_args=f"logs conduwuit --tail={LOG_TAIL_LINES}"
         ):
             print_error("Failed to create admin user")
             sys.exit(1)
+        if admin_status["status"] == "exists":
+            # Retrying can't help; keep the account a previous run created
+            print_warning(f"User {admin_user} already exists with a different password; keeping the existing account")
+        
+        # The token was only needed for the admin account
+        close_registration()
         
         # Final verification
         progress.update_step(9, "Verifying installation")
         def check_final():
-            # Check if services are running
-            returncode, stdout, stderr = run_command("docker-compose ps -a")
-            if "Exit" in stdout or "Restarting" in stdout:
-                return False
-            # Check if we can access the server
-            returncode, stdout, stderr = run_command(f"curl -sk https://{matrix_domain}/_matrix/client/versions")
-            return returncode == 0
+            # Check if services are running and answering locally
+            return not compose_containers_failed() and check_health_endpoint()
         
         if not wait_for_operation(
             "final verification",
             check_final,
             timeout=30,
             check_interval=5,
-            logs_cmd="docker-compose logs"
+            logs_args=f"logs --tail={LOG_TAIL_LINES}"
         ):
             print_error("Final verification failed")
             sys.exit(1)
         
+        # The backend is up, so only DNS and routing are left to check through the public URL
+        public_url = f"https://{matrix_domain}/_matrix/client/versions"
+        if not wait_until(lambda: check_health_endpoint(public_url, timeout=5), timeout=30, interval=1, max_interval=5):
+            print_error(f"Final verification failed: {public_url} is not reachable")
+            sys.exit(1)
+        
         # Installation complete
         progress.update_step(10, "Installation complete")
+        # Nothing left to resume; a later run starts from scratch
+        progress.clear_state()
         
         # Print success message
         print_message("\nInstallation complete!")
@@ -1296,7 +2079,7 @@ def main():
         print(f"  matrix.* → {matrix_domain}")
         print(f"  turn.*  → {turn_domain}")
         
-        if input("\nWould you like to see the DNS and proxy setup instructions again? (y/N): ").lower() == 'y':
+        if timed_input("\nWould you like to see the DNS and proxy setup instructions again? (y/N): ").lower() == 'y':
             print_message("\nDNS Setup Instructions:")
             print("Please ensure these A records exist in your DNS settings:")
             print(f"  {matrix_domain}  A     <your-server-ip>")
@@ -1315,13 +2098,15 @@ def main():
             print("3. Forward matrix traffic to the Conduwuit container")
             print("4. Do not proxy TURN server traffic")
         
-        print("\nManagement commands:")
-        print_message("- View logs: docker-compose logs -f")
-        print_message("- Stop server: docker-compose down")
-        print_message("- Start server: docker-compose up -d")
-        print_message("- Restart server: docker-compose restart")
+        # Show whichever compose CLI this host actually has
+        compose = " ".join(compose_command())
+        print(f"\nManagement commands (run in {INSTALL_DIR}):")
+        print_message(f"- View logs: {compose} logs -f")
+        print_message(f"- Stop server: {compose} down")
+        print_message(f"- Start server: {compose} up -d")
+        print_message(f"- Restart server: {compose} restart")
         
-        print_debug("\nIf you experience any issues, please check the logs using: docker-compose logs")
+        print_debug(f"\nIf you experience any issues, please check the logs using: {compose} logs")
         
     except KeyboardInterrupt:
         print("\nInstallation cancelled by user")